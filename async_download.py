@@ -0,0 +1,149 @@
+import os
+import asyncio
+import functools
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import get_file
+from get_file import ConnectionFailed, HttpError, UrlException
+from FormatLog import FormatLogger
+aiohttp = None # imported by load_aiohttp() on the first download, it is slow to import
+logger = FormatLogger()
+
+def load_aiohttp():
+	""" Returns: the aiohttp module, or None if it is not installed and downloads should run in threads """
+	global aiohttp
+	if aiohttp is None:
+		try:
+			import aiohttp as aiohttp_module
+		except ImportError: # no aiohttp, downloads run in threads using get_file.download_file
+			aiohttp_module = False
+		aiohttp = aiohttp_module
+	return aiohttp or None
+
+#concurrent downloads of all the files of a work
+async def download_files(urls, dwnld_dir, auth_enable=False, auth_user=None, auth_pass=None, per_host=4, limit=16, timeout=300, checksums=None, scheduler=None, names=None):
+	"""
+	Desc: downloads every url into dwnld_dir at the same time, at most per_host at once from any one host
+		and at most limit at once overall. file names come from Content-Disposition or the url like get_file.download_file,
+		a url listed twice is downloaded once and urls whose files have the same name get _1, _2 ... added to it
+	Args: urls (list): the urls to download
+		dwnld_dir (str): the directory to put them in, or a list of one directory per url
+		timeout (int): seconds to wait for a server to connect or send more data
+		checksums (dict): optional, the md5 and sha256 of each file are stored in it under the files path
+		scheduler (download_scheduler.DownloadScheduler): optional, limits disk use and bandwidth across downloads
+		names (get_file.FileNames): optional, names of files already in dwnld_dir (a single directory), by default only these urls are kept apart
+	Returns: list of the absolute paths of the downloaded files, in the same order as urls
+	Raises: the first error of any download, after all the other downloads have finished
+	"""
+	if not urls:
+		return []
+	dirs = dwnld_dir if isinstance(dwnld_dir, list) else [dwnld_dir] * len(urls)
+	names_in = {} # directory -> get_file.FileNames of the files downloaded into it
+	if names is not None and not isinstance(dwnld_dir, list):
+		names_in[dwnld_dir] = names
+	for directory in dirs:
+		if directory not in names_in:
+			if not os.path.exists(directory):
+				get_file.mkdir(directory,['-p'])
+			names_in[directory] = get_file.FileNames()
+	unique = list(dict.fromkeys(zip(urls, dirs)))
+	downloads = [(url, directory, names_in[directory]) for url, directory in unique]
+	if load_aiohttp() is None:
+		results = await download_threaded(downloads, auth_enable, auth_user, auth_pass, per_host, limit, timeout, checksums, scheduler)
+	else:
+		results = await download_aiohttp(downloads, auth_enable, auth_user, auth_pass, per_host, limit, timeout, checksums, scheduler)
+	for result in results:
+		if isinstance(result, BaseException):
+			raise result
+	paths = dict(zip(unique, results))
+	return [paths[download] for download in zip(urls, dirs)]
+
+def download_all(urls, dwnld_dir, **kwargs):
+	""" blocking version of download_files for code that is not async """
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(download_files(urls, dwnld_dir, **kwargs))
+	finally:
+		loop.close()
+
+async def download_aiohttp(downloads, auth_enable, auth_user, auth_pass, per_host, limit, timeout, checksums, scheduler):
+	""" downloads is a list of (url, directory, get_file.FileNames of the directory) """
+	head, cookies = get_file.login(auth_user, auth_pass) if auth_enable else (None, None)
+	connector = aiohttp.TCPConnector(limit=limit, limit_per_host=per_host)
+	client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+	async with aiohttp.ClientSession(connector=connector, timeout=client_timeout, headers=head, cookies=cookies) as session:
+		return await asyncio.gather(*[fetch(session, url, dwnld_dir, checksums, scheduler, names) for url, dwnld_dir, names in downloads], return_exceptions=True)
+
+async def fetch(session, url, dwnld_dir, checksums = None, scheduler = None, names = None):
+	""" downloads one url with an open aiohttp session, the async version of get_file.download_file """
+	get_file.validate_url(url)
+	attempts = 0
+	granted = False # if we have tried to take over dwnld_dir after a PermissionError
+	while True:
+		attempts+=1
+		try:
+			async with session.get(url) as r:
+				if not 200 <= r.status <= 299:
+					text = await r.text(errors='replace')
+					if len(text) >= 100:
+						text = text[:100]+'...'
+					logger.error('failed to download file error:{}, {}'.format(r.status,url))
+					raise HttpError('failed to download file.@{} code:{},body:{}'.format(url,r.status,text),r.status,r.headers.get('Retry-After'))
+				if logger.prints <2:
+					print('downloading file from {}'.format(url))
+				file_name = get_file.get_file_name_from_headers(r.headers) or get_file.get_file_name_from_url(url)
+				if names is not None:
+					file_name = names.claim(url,file_name)
+				local_filename = get_file.join_download_dir(dwnld_dir,file_name)
+				checksum = get_file.Checksum()
+				reserved = await scheduler.start_async(r.headers) if scheduler else 0
+				try:
+					with open(local_filename, 'wb') as f:
+						async for chunk in r.content.iter_chunked(64 * 1024):
+							f.write(chunk)
+							checksum.update(chunk)
+							if scheduler:
+								await asyncio.sleep(scheduler.wrote(len(chunk)))
+				finally:
+					if scheduler:
+						scheduler.finish(reserved,local_filename,checksum.size)
+				headers = r.headers
+			break
+		except PermissionError:
+			# like get_file.download_file, try to take over the directory once before giving up
+			if granted:
+				logger.error("could not acquire permission to download to target dir")
+				raise
+			print('granting access to file')
+			granted = True
+			if get_file.grant_access(dwnld_dir).returncode != 0:
+				logger.error("could not acquire permission to download to target dir")
+				raise
+			print('success')
+		except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+			logger.error('Can not connect...\n',e,'\n',url)
+			if attempts >=3:
+				raise ConnectionFailed('Could not connect to server to download file')
+			await asyncio.sleep(get_file.retry_policy.delay(e,attempts) or 0)
+	file_size = checksum.size
+	if logger.prints <2:
+		print('done downloading %s' % (local_filename),"file size:",file_size)
+	if file_size == 0:
+		logger.error("file size is 0, file must not have downloaded correctly")
+		raise UrlException('Failed to downlaod')
+	get_file.check_content_length(headers,file_size,url)
+	if checksums is not None:
+		checksums[os.path.abspath(local_filename)] = checksum.digests()
+	return os.path.abspath(local_filename)
+
+async def download_threaded(downloads, auth_enable, auth_user, auth_pass, per_host, limit, timeout, checksums, scheduler):
+	""" fallback without aiohttp, runs get_file.download_file in a thread per download """
+	loop = asyncio.get_event_loop()
+	hosts = {} # host -> semaphore limiting downloads from that host
+	with ThreadPoolExecutor(max_workers=limit) as executor:
+		async def fetch_threaded(url, dwnld_dir, names):
+			semaphore = hosts.setdefault(urlsplit(url).netloc, asyncio.Semaphore(per_host))
+			async with semaphore:
+				return await loop.run_in_executor(executor, functools.partial(get_file.download_file,
+					url, dwnld_dir, auth_enable, auth_user, auth_pass, timeout, checksums, scheduler, names))
+		return await asyncio.gather(*[fetch_threaded(url, dwnld_dir, names) for url, dwnld_dir, names in downloads], return_exceptions=True)
@@ -1,16 +1,27 @@
 import sys
 import argparse
 import logging
-import csv
 import re
 import tempfile
 import json
 import os
-from copy import deepcopy
 import shutil
-import subprocess
+import time
+import heapq
+import itertools
 from FormatLog import FormatLogger
 import get_file
+import manifest
+import manifest_cache
+import row_filter
+from rate_control import RateController
+from retry_policy import RetryPolicy
+from failure_log import FailureWriter
+from ingest_backend import RakeBackend, backend_names, otherfiles_modes, create_backend
+from download_scheduler import DownloadScheduler, parse_size
+from shared_resources import SharedResources
+from metrics import Metrics
+from work_stats import WorkMonitor
 
 logger = FormatLogger()
 log = logging.getLogger(__name__)
@@ -22,6 +33,20 @@ required_field_names = ( # for csv, things ending in 1 are multi-valued, everyth
     'creator1',
     'license1'
 )
+class Work():
+    """ the state of a single work as it moves through the ingest.
+        the row given from the manifest is never modified, anything derived from it
+        (downloaded files, generated tiffs) is stored here instead so the original row
+        can be written to ingest.retry exactly as it was read.
+    """
+    __slots__ = ('row','files','first_file','checksums','download_dir')
+    def __init__(self,row):
+        self.row = row # the original row from the csv or json, treat as read only
+        self.files = row.get('files') # path to the file or directory of files for this work
+        self.first_file = row.get('first_file') # path to the primary file, may be None
+        self.checksums = {} # path of each downloaded file -> its md5 and sha256, computed while downloading
+        self.download_dir = None # directory the files of this work were downloaded to, removed after the attempt
+
 class IngestController():
     """ Object that controls the parsing of metadata, file handling, logging nad ingest into hyrax
         the super class for other ingest controllers.
@@ -39,10 +64,29 @@ class IngestController():
         self.debug = None #set in init() & set_flags()
         self.collection = None #set in init() & set_flags()
         self.tiff = None #set in init() & set_flags()
+        self.base_dir = None #set in set_flags()
+        self.rate_controller = None #set in set_flags()
+        self.backend = None #set in set_flags(), where works are ingested to, see ingest_backend.py
+        self.scheduler = None #set in set_flags(), limits disk and bandwidth used by url downloads
+        self.shared_resources = None #set in self.find_shared_resources(), urls listed by more than one work
+        self.metrics = Metrics() #set in set_flags(), progress, throughput and stage timings
+        self.metrics_port = None #set in set_flags()
+        self.work_monitor = WorkMonitor() #set in set_flags(), time and resources used by each work
+        self.parse_workers = None #set in set_flags(), processes to parse a large csv with
+        self.cache_dir = None #set in set_flags(), where to keep parsed manifests for later runs
+        self.row_filter = None #set in set_flags(), which rows of the file to ingest, see row_filter.py
         self.works = None #set in self.__iter__() - in subclasses
         self.current = None #set in self.__next__() - in subclasses
-        self.failed = [] #set in self.run_ingest_process
+        self.num_failed = 0
+        self.retry_file = 'ingest.retry' #set in set_flags(), where works that were not ingested are written
+        self.failure_writer = None #set in self.__iter__() - in subclasses, see failure_log.py
+        self.base_filepath = None #set in self.__iter__() - in subclasses, where relative file paths are found
+        self.raw_download_dir = None #set in self.__iter__() - in subclasses, temporary directory to download work related files
         self.num_success = 0
+        self.retry_policy = RetryPolicy() # decides which failed works are tried again during this run
+        self.deferred = [] # heap of (time to retry, order, attempt, row) for works waiting to be tried again
+        self.deferred_order = itertools.count() # keeps the heap from comparing rows
+        self.retrying = None # the deferred row being tried again right now
     def __iter__(self):
         """
         Desc: set up all needed variable for the iteration through all of the works.
@@ -68,74 +112,219 @@ class IngestController():
         self.auth_pass = auth_pass # HTTP auth password
         self.worktype = worktype # hyrax work type
 
-    def set_flags(self,url = None,debug = None,collection = None, tiff = None):
+    def set_flags(self,url = None,debug = None,collection = None, tiff = None, base_dir = None, rate_control = True,
+                  max_disk = None, max_rate = None, progress = 60, metrics_file = None, metrics_port = None,
+                  retry_file = 'ingest.retry', backend = None, parse_workers = None, cache_dir = None,
+                  row_filter = None, work_timeout = None, slow_percentile = 95, work_stats = None, retry_seed = None):
         """
         Desc: set up flags and optional args
         Args: url (Boolean) if this flag is set, it will look for fulltext_url instead of files
               tiff (Boolean) if flag is used will generate a tiff from primary file and use that as primary file
               debug: (Boolean) debug mode
               collection (str) Optional - the id of the collection to add this work to in hyrax
+              base_dir (str) Optional - dir that relative file paths are found in, defaults to the dir of the file
+              rate_control (Boolean) pace imports by how fast the backend is answering, see rate_control.py
+              max_disk (int) Optional - most bytes of downloaded files to have on disk at once
+              max_rate (int) Optional - most bytes per second to download at
+              progress (int) seconds between progress lines, 0 for none
+              metrics_file (str) Optional - path to keep prometheus metrics in
+              metrics_port (int) Optional - serve prometheus metrics on http://127.0.0.1:<port>/metrics
+              retry_file (str) where to write the works that were not ingested, large runs continue in <retry_file>.2 ...
+              backend (ingest_backend.IngestBackend) Optional - where to ingest works, the rake task from init() by default
+              parse_workers (int) Optional - processes to parse a csv with, by default one per cpu for csvs over 64MB
+              cache_dir (str) Optional - keep the parsed manifest here so later runs of the same file do not parse it again
+              row_filter (row_filter.RowFilter) Optional - ingest only the rows it selects
+              work_timeout (float) Optional - seconds a work may take before the commands it is running are killed
+              slow_percentile (float) warn about works slower than this percentile of the works before them
+              work_stats (str) Optional - path of a csv to write the time and resources used by each work to
+              retry_seed (int) Optional - seeds the jitter of retry waits, so load tests wait the same every run
         """
         self.url = url
         self.debug = debug
         self.collection = collection
         self.tiff = tiff
+        self.base_dir = base_dir
+        if retry_seed is not None:
+            self.retry_policy = RetryPolicy(seed = retry_seed)
+        self.rate_controller = RateController(retry_policy = self.retry_policy) if rate_control else None
+        self.scheduler = DownloadScheduler(max_disk,max_rate)
+        self.metrics = Metrics(progress,metrics_file)
+        self.metrics.bytes_downloaded = self.scheduler.downloaded
+        self.work_monitor = WorkMonitor(slow_percentile,work_timeout,work_stats)
+        self.work_monitor.bytes_downloaded = self.scheduler.downloaded
+        self.work_monitor.stage_seconds = self.metrics.stage_seconds
+        self.metrics_port = metrics_port
+        self.retry_file = retry_file
+        self.parse_workers = parse_workers
+        self.cache_dir = cache_dir
+        self.row_filter = row_filter
+        self.backend = backend or RakeBackend(self.ingest_command,self.ingest_path,self.ingest_depositor,self.worktype,collection)
 
     def run_ingest_process(self):
         """
         Desc: loops though the works given from the iterator returned by self.__iter__()
             called ingest_item for every work in self, logging when works succeed/fail
+            works that fail for a reason worth retrying are tried again later in the run
+            without holding up the works after them.
             calls self.end_ingest_process after iteration stops.
         """
         try:
-            for row in self:
+            works = iter(self) # loads the file, __iter__ returns self so a for loop would load it again
+            self.metrics.start(len(self.works))
+            if self.metrics_port:
+                self.metrics.serve(self.metrics_port)
+            while True:
                 try:
-                    upload_id = self.get_identifier(row)
-                    row_to_ingest = deepcopy(row) # ingest_item may modify the row, we want to keep original untouched
-                    self.ingest_item(row_to_ingest,upload_id)
-                    self.num_success += 1
-                except Exception as e:
-                    logger.error(e.__class__.__name__,e)
-                    logger.failure("%s was not ingested" % (upload_id) )
-                    self.failed.append(row)
-                    if logger.num_success == 0 and logger.num_fail >= 5:
-                        print("Warning: Ingest Failed first 5 in a row!")
-
-                logger.status('End of',upload_id,'\n')
+                    row = next(works)
+                except StopIteration:
+                    break
+                self.ingest_deferred()
+                self.attempt_ingest(row,1)
+            self.ingest_deferred(wait = True)
         except KeyboardInterrupt as yikes_stop_error:
             logger.critical(KeyboardInterrupt)
+            # works waiting to be retried have not been ingested
+            interrupted = [row for _,_,_,row in sorted(self.deferred)]
+            if self.retrying is not None:
+                interrupted.append(self.retrying)
+            for row in interrupted:
+                self.record_failure(row,'Interrupted','not attempted','stopped before the work could be tried again')
+            self.deferred = []
             self.end_ingest_process()
             return
         self.end_ingest_process()
 
-    def write_metadata_and_ingest(self,metadata,row,raw_download_dir,base_filepath):
-        """ takes the metadata for a work,  ingests the work into hyrax using rake task in config.py
+    def attempt_ingest(self,row,attempt):
         """
-        #get configuration
-        ingest_command = self.ingest_command
-        ingest_path = self.ingest_path
-        ingest_depositor = self.ingest_depositor
-        worktype = self.worktype
-        debug = self.debug
-        collection = self.collection
+        Desc: tries to ingest one work, on failure either defers it to be tried again or records it as failed
+        Args: row: the object representing the work to be ingested
+              attempt (int): which attempt this is for this work, starting at 1
+        """
+        upload_id = None
+        work = Work(row)
+        self.work_monitor.begin()
+        try:
+            upload_id = self.get_identifier(row)
+            self.ingest_item(work,upload_id)
+            self.num_success += 1
+            self.work_monitor.end(upload_id,attempt,None,work.download_dir)
+            self.clean_up_work(work)
+            self.work_done(row)
+            self.metrics.work_finished(True,len(self.deferred))
+        except Exception as e:
+            self.work_monitor.end(upload_id,attempt,e,work.download_dir,self.retry_policy.classify(e))
+            if not self.debug: # in debug mode keep the files of failed works to look at
+                self.clean_up_work(work)
+            wait = self.retry_policy.delay(e,attempt)
+            if wait is not None:
+                logger.warning("{} failed ({} error: {}), trying again in {:.1f} seconds".format(
+                    upload_id,self.retry_policy.classify(e),e.__class__.__name__,wait))
+                heapq.heappush(self.deferred,(time.monotonic() + wait,next(self.deferred_order),attempt + 1,row))
+                self.metrics.work_deferred(len(self.deferred))
+            else:
+                logger.error(e.__class__.__name__,e)
+                logger.failure("%s was not ingested" % (upload_id) )
+                self.record_failure(row,e.__class__.__name__,self.retry_policy.classify(e),e)
+                self.work_done(row)
+                self.metrics.work_finished(False,len(self.deferred))
+                if logger.num_success == 0 and logger.num_fail >= 5:
+                    print("Warning: Ingest Failed first 5 in a row!")
+
+        logger.status('End of',upload_id,'\n')
+
+    def record_failure(self,row,error_class,retry_class,message):
+        """ writes a work that will not be ingested this run to the retry file right away """
+        self.num_failed += 1
+        try:
+            identifier = self.get_identifier(row)
+        except (KeyError,TypeError): # the work may have failed for not having one
+            identifier = None
+        self.failure_writer.write(row,identifier,error_class,retry_class,message)
+
+    def clean_up_work(self,work):
+        """ removes the files downloaded for a work as soon as we are done with it, so the disk does not fill up """
+        if work.download_dir:
+            shutil.rmtree(work.download_dir, ignore_errors=True)
+            self.scheduler.release_dir(work.download_dir)
+
+    def select_rows(self,rows):
+        """ Returns: the rows chosen by --rows, --ids, --match and --shard, call in __iter__() """
+        if not self.row_filter:
+            return rows
+        index = None
+        if self.row_filter.identifiers is not None and self.cache_dir:
+            # with the cache an index of identifiers to row numbers finds --ids without reading every row
+            kind = 'json' if self.row_filter.use_json else 'csv'
+            index = row_filter.identifier_index(rows,self.file_path,manifest_cache.cache_path(self.cache_dir,self.file_path,kind) + '.ids',self.row_filter.use_json)
+        selected = self.row_filter.select(rows,index)
+        logger.info('Selected {} of the {} works in {}'.format(len(selected),len(rows),self.file_path))
+        return selected
+
+    def find_shared_resources(self):
+        """ with urls, finds the urls listed by more than one work so they are only downloaded once, call in __iter__() """
+        if self.url:
+            self.shared_resources = SharedResources(os.path.join(self.raw_download_dir,'.shared'))
+            self.shared_resources.count(self.works)
+
+    def work_done(self,row):
+        """ a work has been ingested or has failed for good """
+        if self.shared_resources:
+            self.shared_resources.done(row,self.scheduler)
 
+    def ingest_deferred(self,wait = False):
+        """
+        Desc: tries again the deferred works that are due
+        Args: wait (Boolean): if True sleep until every deferred work has been tried, used after the last work
+        """
+        while self.deferred:
+            remaining = self.deferred[0][0] - time.monotonic()
+            if remaining > 0:
+                if not wait:
+                    return
+                time.sleep(remaining)
+            _, _, attempt, self.retrying = heapq.heappop(self.deferred)
+            self.attempt_ingest(self.retrying,attempt)
+            self.retrying = None
+
+    def write_metadata_and_ingest(self,metadata,work,raw_download_dir,base_filepath):
+        """ takes the metadata for a work (and the Work holding its files),  ingests the work using self.backend
+            (the rake task in config.py unless --backend says otherwise)
+        """
+        debug = self.debug
 
         metadata_temp_path = tempfile.mkdtemp()
         metadata_filepath = os.path.join(metadata_temp_path, 'metadata.json')
 
+        if work.checksums:
+            # digests computed while downloading, so hyrax does not have to read the files again for fixity
+            metadata['fixity'] = [dict(file=os.path.basename(path), **digests) for path, digests in sorted(work.checksums.items())]
         try:
             with open(metadata_filepath, 'w') as repo_metadata_file:
                 json.dump(metadata, repo_metadata_file, indent=4)
                 log.debug('Writing to {}: {}'.format(metadata_filepath, json.dumps(metadata)))
             try:
-                first_file, other_files = find_files(row['files'], row.get('first_file'), base_filepath)
-                # TODO: Handle passing existing repo id
-                repo_id = repo_import(metadata_filepath, metadata['title'], first_file, other_files, None,
-                                      ingest_command,
-                                      ingest_path,
-                                      ingest_depositor,
-                                      worktype,
-                                      collection)
+                first_file, other_files = find_files(work.files, work.first_file, base_filepath)
+                if self.rate_controller:
+                    # pacing is not the work's fault, it does not count against its time or --work-timeout
+                    with self.work_monitor.paused():
+                        self.rate_controller.wait()
+                start = time.monotonic()
+                try:
+                    # TODO: Handle passing existing repo id
+                    with self.metrics.time('import'):
+                        repo_id = self.backend.deposit(metadata_filepath, metadata, first_file, other_files,
+                                                       timeout = self.work_monitor.remaining())
+                except Exception as e:
+                    if self.rate_controller:
+                        # classified with the same policy as the retries, only congestion slows the pace
+                        latency = time.monotonic() - start
+                        with self.work_monitor.paused(): # may back off after a burst of failures
+                            self.rate_controller.record(latency, False, e)
+                    raise
+                if self.rate_controller:
+                    # a large work takes long without the backend being any slower
+                    size = sum(os.path.getsize(path) for path in [first_file] + list(other_files))
+                    self.rate_controller.record(time.monotonic() - start, True, size = size)
                 # TODO: Write repo id to output CSV
             except Exception as e:
                 # TODO: Record exception to output CSV
@@ -148,11 +337,11 @@ class IngestController():
     def get_identifier(self,row):
         raise NotImplementedError
 
-    def ingest_item(self,row,upload_id):
+    def ingest_item(self,work,upload_id):
         """
-        Desc: this method takes in a row and the identifier for the work and
+        Desc: this method takes in a work and the identifier for the work and
             prepares metadata and files then ingests said work into hyrax.
-        Args:   row: the object representing the work to be ingested
+        Args:   work (Work): the work to be ingested, work.row must not be modified
                 upload_id: (str) the name for the work for logging purposes
         Returns void - nothing is returned, the work is ingested
         """
@@ -161,7 +350,37 @@ class IngestController():
     def end_ingest_process(self):
         """
         Desc: does anything needed to be done after the process is complete
+            works that were never tried are added to the retry file, which already has every failure
         """
+        # we ended the process early for some reason
+        done = self.num_failed + self.num_success
+        if self.works is not None and done < len(self.works):
+            logger.warning("Ingest process did not run to completion. saving the remaining",
+                len(self.works) - done,"works into {} in addition to any failures".format(self.retry_file))
+            for n in range(done,len(self.works)):
+                self.record_failure(self.works[n],'NotAttempted','not attempted','the ingest stopped before this work')
+        # some works were not ingested
+        if self.failure_writer:
+            parts = self.failure_writer.close()
+            commandline_args = ' '.join(sys.argv[2:])
+            if not self.url and '--base-dir' not in sys.argv:
+                commandline_args += ' --base-dir {}'.format(self.base_filepath)
+            if parts:
+                logger.status("to run the ingest again on only the failed works use the following command{}:\n".format('s' if len(parts) > 1 else ''),
+                              '\n'.join("python batch_loader.py {} {}".format(part,commandline_args) for part in parts))
+        if not self.debug and self.raw_download_dir:
+            logger.status('Removing downloaded files from directory tree')
+            shutil.rmtree(self.raw_download_dir, ignore_errors=True)
+        self.metrics.stop()
+        if self.rate_controller and self.rate_controller.imports:
+            logger.status('Rate control:',self.rate_controller.summary())
+        if self.shared_resources and self.shared_resources.downloads_saved:
+            logger.status(self.shared_resources.summary())
+        if self.backend:
+            self.backend.close()
+        if self.work_monitor.num_slow:
+            logger.status(self.work_monitor.summary())
+        self.work_monitor.close()
         logger.close()
 
 class CsvIngestController(IngestController):
@@ -171,9 +390,8 @@ class CsvIngestController(IngestController):
         self.singular_field_names = None # fields that will be scalar in ingest
         self.repeating_field_names = None # fields that will be a list
         self.current = 0 # the index of the current work we going to ingest
-        self.base_filepath = None # where the csv is stored, used for non url ingests
-        self.raw_download_dir = None # temporary directory to download work related files
         self.field_names = None # original field names given in the csv
+        self.header = None # manifest.CsvHeader shared by all rows in self.works
 
     def __iter__(self):
         """
@@ -182,7 +400,7 @@ class CsvIngestController(IngestController):
         Returns: self (CsvIngestController), an iterator object.
 
         """
-        self.base_filepath = os.path.dirname(os.path.abspath(self.file_path))
+        self.base_filepath = self.base_dir or os.path.dirname(os.path.abspath(self.file_path))
         self.raw_download_dir = tempfile.mkdtemp()
 
         logging.basicConfig(
@@ -190,14 +408,17 @@ class CsvIngestController(IngestController):
         )
         logging.basicConfig(level=logging.DEBUG)
 
-        field_names, rows = load_csv(self.file_path)
-        self.field_names = field_names
+        header, rows = load_csv(self.file_path,self.parse_workers,self.cache_dir)
+        self.header = header
+        field_names = self.field_names = list(header.field_names)
         logger.info('Loading {} objects from file: {}'.format(len(rows), self.file_path))
         validate_field_names(field_names,self.url)
         self.singular_field_names, self.repeating_field_names = analyze_field_names(field_names)
         logger.write('')#newline for clean looking log
-        self.works = rows
+        self.works = self.select_rows(rows)
         self.current = 0
+        self.failure_writer = FailureWriter(self.retry_file,header,input_path = self.file_path)
+        self.find_shared_resources()
         return self
 
     def __next__(self):
@@ -211,38 +432,41 @@ class CsvIngestController(IngestController):
         except IndexError:
             raise StopIteration
 
-    def ingest_item(self,row,upload_id):
+    def ingest_item(self,work,upload_id):
         """
-        Desc: this method takes in a row and the identifier for the work and
+        Desc: this method takes in a work and the identifier for the work and
             prepares metadata and files then ingests said work into hyrax.
-        Args:   row:
+        Args:   work (Work): the work wrapping a row of the csv
                 upload_id: (str) the name for the work for logging purposes
         Returns void - nothing is returned, the work is ingested
         """
         logger.status("uploading",upload_id)
-        if 'first_file' in row:
-            full_file_path = row['first_file']
-        if 'files' in row:
-            files_dir = row['files']
+        row = work.row
+        full_file_path = work.first_file
         if self.url: #boolean representing if we are using urls to get relevant file(s)
             logger.status("downloading %s"%(row['fulltext_url']))
-            files_dir, full_file_path = rip_files_from_url(row, self.raw_download_dir, self.auth_enable, self.auth_user, self.auth_pass)
-            #full_file_path  = get_file.download_file(row['fulltext_url'],dwnld_dir = raw_download_dir)
-            row['files'] = files_dir
-            row['first_file'] = full_file_path
+            work.download_dir = make_project_dir(row, self.raw_download_dir)
+            with self.metrics.time('download'):
+                files_dir, full_file_path = rip_files_from_url(row, self.raw_download_dir, self.auth_enable, self.auth_user, self.auth_pass, work.checksums, self.scheduler,
+                                                               shared = self.shared_resources,
+                                                               proj_dir = work.download_dir)
+                #full_file_path  = get_file.download_file(row['fulltext_url'],dwnld_dir = raw_download_dir)
+            work.files = files_dir
+            work.first_file = full_file_path
         if self.tiff: # if we want to generate a tiff, and have it be the primary file
-            if 'files' not in row:
+            if work.files is None:
                 raise ValueError("no files "+str(row))
-            if isinstance(row['files'], list):
-                files_dir,full_file_path =  make_tiff_from_file(full_file_path,row['files'],True)
-            elif isinstance(row['files'], str) and os.path.isdir(row['files']):
-                files_dir, full_file_path = make_tiff_from_file(full_file_path)
-            else:
-                raise ValueError("no files, cause files is not string or path to dir "+str(row))
-            row['files'] = files_dir
-            row['first_file'] = full_file_path
+            with self.metrics.time('tiff'):
+                if isinstance(work.files, list):
+                    files_dir,full_file_path =  make_tiff_from_file(full_file_path,work.files,True,timeout = self.work_monitor.remaining())
+                elif isinstance(work.files, str) and os.path.isdir(work.files):
+                    files_dir, full_file_path = make_tiff_from_file(full_file_path,timeout = self.work_monitor.remaining())
+                else:
+                    raise ValueError("no files, cause files is not string or path to dir "+str(row))
+            work.files = files_dir
+            work.first_file = full_file_path
         metadata = create_repository_metadata(row, self.singular_field_names, self.repeating_field_names)#todo
-        self.write_metadata_and_ingest(metadata,row,self.raw_download_dir,self.base_filepath)
+        self.write_metadata_and_ingest(metadata,work,self.raw_download_dir,self.base_filepath)
         # at this point the metadata is a dictionary
         # of all the metadata where reapeating values are key : [value,value]
         # and scalars are key : value
@@ -254,50 +478,25 @@ class CsvIngestController(IngestController):
         #with csv this must contain 1 because title and identifier are not scalar
         return row['title1'] if 'identifier1' not in row else row['identifier1'] #TODO refactor
 
-    def end_ingest_process(self):
-        if self.current < len(self.works) -1 or len(self.failed) + self.num_success < len(self.works):
-            current = len(self.failed) + self.num_success
-            self.failed.extend(self.works[current:])
-            logger.warning("Ingest process did not run to completion. saving the remaining",
-                len(self.works[current:]),"works into ingest.retry in addition to any failures")
-        if self.failed:
-            retry_file = "ingest.retry"
-            with open("ingest.retry",'w') as csvfile:
-                writer = csv.DictWriter(csvfile,fieldnames = self.field_names)
-                writer.writeheader()
-                for row in self.failed:
-                    writer.writerow(row)
-            commandline_args = sys.argv[2:]
-            path = self.base_filepath+"/"+retry_file
-            if self.url:
-                logger.status("to run the ingest again on only the failed works use the following command:\n",
-                              "python batch_loader.py {} {}".format(retry_file,' '.join(commandline_args)))
-            else:
-                logger.status("to run the ingest again on only the failed works use the following commands:\n",
-                              "mv {} {}\n".format(retry_file,path),
-                              "python batch_loader.py {} {}".format(path,' '.join(commandline_args)))
-        if not self.debug:
-            logger.status('Removing downloaded files from directory tree')
-            shutil.rmtree(self.raw_download_dir, ignore_errors=True)
-
-        super().end_ingest_process()
-
 class JsonIngestController(IngestController):
     def __init__(self,*args,**kwargs):
         super().__init__(*args,**kwargs)
         self.current = 0
-        self.base_filepath = None
-        self.raw_download_dir = None
 
     def __iter__(self):
         #self.file_path,ingest_command,ingest_path,ingest_depositor,worktype,url = None,debug = None,collection = None, tiff = None
-        with open(self.file_path,'r') as jf:
-            rows = json.load(jf)
+        if self.cache_dir:
+            rows = manifest_cache.load_json(self.file_path,self.cache_dir)
+        else:
+            with open(self.file_path,'r') as jf:
+                rows = manifest.load_json_rows(jf)
             ### required for only certain types of ingest ###
         self.raw_download_dir = tempfile.mkdtemp() # for url downloads
-        self.base_filepath = os.path.dirname(os.path.abspath(self.file_path)) #this is where files are if we dont need to download them
-        self.works = rows
-        logger.info('Loading {} objects from file: {}'.format(len(self.works), self.file_path))
+        self.base_filepath = self.base_dir or os.path.dirname(os.path.abspath(self.file_path)) #this is where files are if we dont need to download them
+        logger.info('Loading {} objects from file: {}'.format(len(rows), self.file_path))
+        self.works = self.select_rows(rows)
+        self.failure_writer = FailureWriter(self.retry_file,input_path = self.file_path)
+        self.find_shared_resources()
         return self
 
     def __next__(self):
@@ -308,71 +507,48 @@ class JsonIngestController(IngestController):
         except IndexError:
             raise StopIteration
 
-    def ingest_item(self,row,upload_id):
+    def ingest_item(self,work,upload_id):
         """
-        Desc: this method takes in a row and the identifier for the work and
+        Desc: this method takes in a work and the identifier for the work and
             prepares metadata and files then ingests said work into hyrax.
-        Args:   row:
+        Args:   work (Work): the work wrapping an object from the json file
                 upload_id: (str) the name for the work for logging purposes
         Returns void - nothing is returned, the work is ingested
         """
         logger.status("uploading",upload_id)
+        row = work.row
         validate_metadata_json(row,self.url) # ensures that the required stuff is there and that its the right type
         if not self.url:
             files_dir=row['files']
             full_file_path=row['first_file']
         if self.url:
-            files_dir, full_file_path = rip_files_from_url(row, self.raw_download_dir, self.auth_enable, self.auth_user, self.auth_pass)
+            work.download_dir = make_project_dir(row, self.raw_download_dir)
+            with self.metrics.time('download'):
+                files_dir, full_file_path = rip_files_from_url(row, self.raw_download_dir, self.auth_enable, self.auth_user, self.auth_pass, work.checksums, self.scheduler,
+                                                               shared = self.shared_resources,
+                                                               proj_dir = work.download_dir)
         if self.tiff:
-            if not os.path.isdir(files_dir):
-                files_dir,full_file_path = make_tiff_from_file(full_file_path,new_dir=True)
-            else:
-                files_dir,full_file_path = make_tiff_from_file(full_file_path)
-
-        ### prepare row for ingest ###
-        row['files'] = files_dir
-        row['first_file'] = full_file_path
+            with self.metrics.time('tiff'):
+                if not os.path.isdir(files_dir):
+                    files_dir,full_file_path = make_tiff_from_file(full_file_path,new_dir=True,timeout = self.work_monitor.remaining())
+                else:
+                    files_dir,full_file_path = make_tiff_from_file(full_file_path,timeout = self.work_monitor.remaining())
+
+        ### prepare work for ingest ###
+        work.files = files_dir
+        work.first_file = full_file_path
         metadata = {}
         for key in row:
-            if key != 'files' and key != 'first_file' and key != 'resources' and key != 'fulltext_url':
+            if key != 'files' and key != 'first_file' and key != 'resources' and key != 'fulltext_url' and key != 'fulltext_checksum':
                 metadata[key] = row[key]
         ##############################
-        self.write_metadata_and_ingest(metadata,row,self.raw_download_dir,self.base_filepath)
+        self.write_metadata_and_ingest(metadata,work,self.raw_download_dir,self.base_filepath)
         logger.success("Ingested",upload_id)
 
     def get_identifier(self,row):
         #what to call this for logging
         return row['title'] if 'identifier' not in row else row['identifier']
 
-    def end_ingest_process(self):
-        # we ended the process early for some reason
-        if self.current < len(self.works) -1 or len(self.failed) + self.num_success < len(self.works):
-            current = len(self.failed) + self.num_success
-            self.failed.extend(self.works[current:])
-            logger.warning("Ingest process did not run to completion. saving the remaining",
-                len(self.works[current:]),"works into ingest.retry in addition to any failures")
-
-        # some works were not ingested
-        if self.failed:
-            retry_file = "ingest.retry"
-            with open(retry_file,'w') as jsonfile:
-                # json_dump = [] # prepared records
-                jsonfile.write(json.dumps(self.failed, indent=4))
-            commandline_args = sys.argv[2:]
-            path = self.base_filepath+"/"+retry_file
-            if self.url:
-                logger.status("to run the ingest again on only the failed works use the following command:\n",
-                              "python batch_loader.py {} {}".format(retry_file,' '.join(commandline_args)))
-            else:
-                logger.status("to run the ingest again on only the failed works use the following commands:\n",
-                              "mv {} {}\n".format(retry_file,path),
-                              "python batch_loader.py {} {}".format(path,' '.join(commandline_args)))
-        if not self.debug:
-            logger.status('Removing downloaded files from directory tree')
-            shutil.rmtree(self.raw_download_dir, ignore_errors=True)
-        # close the log and stuff in super class method
-        super().end_ingest_process()
-
 class IngestFactory():
     @classmethod
     def create_controller(cls,args,config):
@@ -381,8 +557,16 @@ class IngestFactory():
         else:#csv, default
             ingest_controller = CsvIngestController()
 
+        backend = create_backend(args.backend,config,args.worktype,args.collection,args.ingest_url,args.package_dir,args.upload_workers,args.otherfiles,
+                                 args.journal,args.sim_speed,args.sim_seed,replay_downloads = not args.url)
         ingest_controller.init(args.file,config.ingest_command,config.ingest_path,config.ingest_depositor,config.auth_enable,config.auth_user,config.auth_pass,args.worktype)
-        ingest_controller.set_flags(url = args.url,debug = args.debug,collection = args.collection,tiff = args.tiff)
+        ingest_controller.set_flags(url = args.url,debug = args.debug,collection = args.collection,tiff = args.tiff,base_dir = args.base_dir,
+                                    rate_control = not args.no_rate_control,max_disk = args.max_disk,max_rate = args.max_rate,
+                                    progress = args.progress,metrics_file = args.metrics_file,metrics_port = args.metrics_port,
+                                    retry_file = args.retry_file,backend = backend,parse_workers = args.parse_workers,
+                                    cache_dir = args.cache_dir,row_filter = row_filter.create_row_filter(args),
+                                    work_timeout = args.work_timeout,slow_percentile = args.slow_percentile,work_stats = args.work_stats,
+                                    retry_seed = args.sim_seed if args.backend == 'simulated' else None)
         return ingest_controller
 
 
@@ -412,15 +596,10 @@ def validate_metadata_json(metadata,use_url):
     return
 
 
-def rip_files_from_url(row, raw_download_dir, auth_enable=False, auth_user=None, auth_pass=None):
+def make_project_dir(row, raw_download_dir):
     """
-    Desc: takes in a row of metadata including 'fulltext_url' and optionally 'resources'
-        downloads all files to new directory insdie the raw_download_dir directory returns
-        path to the dir containing the files, and the first files path
-    Args: row (dict): metadata for the work
-          raw_download_dir (str): path to the place these files should be stored
-    returns: tuple: first element is the path to the directory containing relevant resources:
-                    second element is the path to the primary file for the work
+    Desc: makes the directory the files of a work are downloaded to, named after the identifier if there is one
+    Returns: the path to the directory
     """
     if 'identifier' in row and row['identifier']:
         if isinstance(row['identifier'],list):
@@ -436,21 +615,53 @@ def rip_files_from_url(row, raw_download_dir, auth_enable=False, auth_user=None,
             raise FileNotFoundError('could not create project dir')
     else:
         proj_dir = tempfile.mkdtemp(dir=raw_download_dir)
+    return proj_dir
 
+def rip_files_from_url(row, raw_download_dir, auth_enable=False, auth_user=None, auth_pass=None, checksums=None, scheduler=None, proj_dir=None, shared=None):
+    """
+    Desc: takes in a row of metadata including 'fulltext_url' and optionally 'resources' and 'fulltext_checksum'
+        downloads all files to new directory insdie the raw_download_dir directory returns
+        path to the dir containing the files, and the first files path
+    Args: row (dict): metadata for the work
+          raw_download_dir (str): path to the place these files should be stored
+          checksums (dict): optional, filled with the md5 and sha256 of each downloaded file by path
+          scheduler (DownloadScheduler): optional, limits disk use and bandwidth of the downloads
+          proj_dir (str): optional, directory from make_project_dir() to download to instead of making one
+          shared (SharedResources): optional, urls it knows are shared are downloaded once and hard linked in
+    returns: tuple: first element is the path to the directory containing relevant resources:
+                    second element is the path to the primary file for the work
+    """
+    if proj_dir is None:
+        proj_dir = make_project_dir(row, raw_download_dir)
 
+    urls = [row['fulltext_url']]
     if 'resources' in row and row['resources']:
-        for resource in row['resources']:
-            get_file.download_file(resource,dwnld_dir = proj_dir, auth_enable=auth_enable, auth_user=auth_user, auth_pass=auth_pass)
-    full_file_path  = get_file.download_file(row['fulltext_url'],dwnld_dir = proj_dir, auth_enable=auth_enable, auth_user=auth_user, auth_pass=auth_pass)
+        urls += row['resources']
+    # all of the works files are downloaded at once, see async_download.py
+    import async_download # imported here so ingests of local files do not import asyncio
+    if checksums is None:
+        checksums = {}
+    names = get_file.FileNames() # two urls of the work with the same file name must not overwrite each other
+    shared_urls = [url for url in urls if shared is not None and shared.is_shared(url)]
+    own_urls = [url for url in urls if url not in shared_urls]
+    downloaded = dict(zip(own_urls, async_download.download_all(own_urls, proj_dir, auth_enable=auth_enable, auth_user=auth_user, auth_pass=auth_pass, checksums=checksums, scheduler=scheduler, names=names)))
+    if shared_urls:
+        shared.download(shared_urls, async_download.download_all, auth_enable=auth_enable, auth_user=auth_user, auth_pass=auth_pass, scheduler=scheduler)
+        for url in shared_urls:
+            downloaded[url] = shared.link(url, proj_dir, checksums, names)
+    full_file_path = downloaded[row['fulltext_url']]
+    if row.get('fulltext_checksum'):
+        get_file.verify_checksum(full_file_path, checksums[full_file_path], row['fulltext_checksum'])
     return proj_dir, full_file_path
 
-def make_tiff_from_file(full_file_path,files = None,new_dir = False):
+def make_tiff_from_file(full_file_path,files = None,new_dir = False,timeout = None):
     """ generates a tiff for the file at full_file_path, places it in the same directory.
         if new_dir flag evaluates as true, then will create a new directory and place both files there
+        convert is killed if it runs longer than timeout seconds
     """
     if files is None:
         files = []
-    generated_tiff = get_file.create_tiff_imagemagick(full_file_path)
+    generated_tiff = get_file.create_tiff_imagemagick(full_file_path,timeout)
     tiff_name = os.path.basename(generated_tiff)
     if new_dir: #prob not actually gonna use this, im confused.
         new_dir = get_file.create_dir_for([full_file_path,generated_tiff]+files)
@@ -486,14 +697,16 @@ def write_metadata_and_ingest(metadata,row,raw_download_dir,base_filepath,ingest
             #shutil.rmtree(raw_download_dir, ignore_errors=True)
 
 
-def load_csv(filepath):
+def load_csv(filepath,workers = None,cache_dir = None):
     """
-    Reads CSV and returns field names, rows
+    Reads CSV and returns the header (manifest.CsvHeader), rows (list of manifest.CsvRow)
+    large csvs are parsed by workers processes, by default one per cpu, see manifest.read_csv_file
+    with a cache_dir the parsed csv is kept there and read back on later runs, see manifest_cache.py
     """
     log.debug('Loading csv')
-    with open(filepath) as csvfile:
-        reader = csv.DictReader(csvfile)
-        return reader.fieldnames, list(reader)
+    if cache_dir:
+        return manifest_cache.load_csv(filepath,cache_dir,workers)
+    return manifest.read_csv_file(filepath,workers)
 
 
 def validate_field_names(field_names,use_url):
@@ -546,8 +759,10 @@ def analyze_field_names(field_names):
         singular_field_names.remove('fulltext_url')
     if 'first_file' in singular_field_names:
         singular_field_names.remove('first_file')
-    logger.status('Singular field names: {}'.format(singular_field_names))
-    logger.status('Repeating field names: {}'.format(repeating_field_names))
+    if 'fulltext_checksum' in singular_field_names:
+        singular_field_names.remove('fulltext_checksum')
+    log.debug('Singular field names: {}'.format(singular_field_names))
+    log.debug('Repeating field names: {}'.format(repeating_field_names))
     return singular_field_names, repeating_field_names
 
 
@@ -645,34 +860,11 @@ def repo_import(repo_metadata_filepath, title, first_file, other_files, reposito
         collectoin (str): the id of the collection in hyrax to add this work to
     Returns: the id of the work in hyrax
     """
-    logger.info('Importing', title)
-    # rake gwss:ingest_etd -- --manifest='path-to-manifest-json-file' --primaryfile='path-to-primary-attachment-file/myfile.pdf' --otherfiles='path-to-all-other-attachments-folder'
-    command = ingest_command.split(' ') + ['--',
-                                           '--manifest=%s' % repo_metadata_filepath,
-                                           '--primaryfile=%s' % first_file,
-                                           '--depositor=%s' % ingest_depositor,
-                                           '--worktype=%s' % worktype]
-    if collection:
-        command += ['--collection=%s' % collection]
-    if other_files:
-        command.extend(['--otherfiles=%s' % '{|,|}'.join(other_files)]) # our files have commas
-    if repository_id:
-        log.info('%s is an update.', title)
-        command.extend(['--update-item-id=%s' % repository_id])
-    space = "\r" + ''.join([' ']*200)
-    logger.info(space+"\r\tCommand is: %s\n" % ' '.join(command))
-    if logger.prints < 3:
-        output = subprocess.check_output(command, cwd=ingest_path)
-    else:
-        output = subprocess.check_output(command, cwd=ingest_path,stderr=subprocess.DEVNULL)
-    repository_id = output.decode('utf-8').rstrip('\n')
-    logger.info('Repository id for',title,'is', repository_id)
-    return repository_id
+    backend = RakeBackend(ingest_command,ingest_path,ingest_depositor,worktype,collection)
+    return backend.deposit(repo_metadata_filepath,{'title' : title},first_file,other_files,repository_id)
 
 
 if __name__ == '__main__':
-    import config
-    logger.init('ingest.log','ingest_failures.log','ingest_status.log',truncate = True)
     parser = argparse.ArgumentParser(description='Loads into digitalWPI from CSV (or Json)')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('file', help='filepath of CSV file or Json')
@@ -681,12 +873,48 @@ if __name__ == '__main__':
     parser.add_argument('--collection',type=str,help='the id of the collection to add this work to in hyrax',default=None)
     parser.add_argument('--tiff',action='store_true',help='if flag is used will generate a tiff from primary file and use that as primary file')
     parser.add_argument('--json', action='store_true',help='if the file containing the metadata for the works is a json file, use this flag.')
+    parser.add_argument('--base-dir',type=str,help='directory that relative paths in files and first_file are found in [default: the directory of the file]',default=None)
+    parser.add_argument('--no-rate-control',action='store_true',help='import as fast as possible instead of slowing down when the ingest backend is slow or failing')
+    parser.add_argument('--max-disk',type=parse_size,help='with --url, the most downloaded data to keep on disk at once ie 20G',default=None)
+    parser.add_argument('--max-rate',type=parse_size,help='with --url, the most bytes per second to download at ie 10M',default=None)
+    parser.add_argument('--progress',type=int,help='seconds between progress lines with throughput and ETA, 0 for none [default: 60]',default=60)
+    parser.add_argument('--metrics-file',type=str,help='keep prometheus format metrics in this file, ie for the node_exporter textfile collector',default=None)
+    parser.add_argument('--metrics-port',type=int,help='serve prometheus format metrics on http://127.0.0.1:<port>/metrics',default=None)
+    parser.add_argument('--backend',choices=backend_names,help='how to ingest works: the rake task in config.py, http deposit to --ingest-url, or directory to write bag-like packages to --package-dir as a dry run, or simulated to replay --journal as a load test [default: rake]',default='rake')
+    parser.add_argument('--ingest-url',type=str,help='with --backend http, the url to deposit to [default: ingest_url in config.py]',default=None)
+    parser.add_argument('--package-dir',type=str,help='with --backend directory, where to write the packages [default: packages]',default='packages')
+    parser.add_argument('--upload-workers',type=int,help='with --backend http, how many files of a work to upload at once [default: 4]',default=4)
+    parser.add_argument('--journal',type=str,help='with --backend simulated, the --work-stats csv of a run to replay, see simulate.py',default=None)
+    parser.add_argument('--sim-speed',type=float,help='with --backend simulated, replay this many times faster than recorded [default: 1]',default=1.0)
+    parser.add_argument('--sim-seed',type=int,help='with --backend simulated, seeds the retry waits and which recorded work a new work replays [default: 0]',default=0)
+    parser.add_argument('--otherfiles',choices=otherfiles_modes,help='how the files after the first are given to the rake task: --otherfiles= joined by {|,|}, --otherfiles-list= a file listing them, or --otherfiles-tar=- a tar of them on stdin. with --backend http tar sends them in one request [default: args, a list when there are too many]',default='args')
+    parser.add_argument('--parse-workers',type=int,help='processes to parse the csv with, 1 for none [default: one per cpu for csvs over 64MB]',default=None)
+    parser.add_argument('--cache-dir',type=str,help='keep the parsed file here, later runs of the same unchanged file start without parsing it again',default=None)
+    parser.add_argument('--rows',type=row_filter.parse_row_range,help='only ingest rows START:END of the file, counting from 0 like a python slice ie 100:200',default=None)
+    parser.add_argument('--ids',type=row_filter.parse_identifiers,help='only ingest the works with these identifiers (or titles), separated by commas, or @file with one per line',default=None)
+    parser.add_argument('--match',type=row_filter.parse_match,action='append',help='only ingest works where the field matches the regex ie title1=^Annual, can be given more than once',default=None)
+    parser.add_argument('--shard',type=row_filter.parse_shard,help='only ingest shard I of N (I counts from 0), split like --workers splits the file, see --shard-by',default=None)
+    parser.add_argument('--work-timeout',type=float,help='seconds a work may take, a convert or ingest still running after that is killed and the work fails [default: no limit]',default=None)
+    parser.add_argument('--slow-percentile',type=float,help='warn about works slower than this percentile of the works before them [default: 95]',default=95)
+    parser.add_argument('--work-stats',type=str,help='write the wall time, child cpu time, disk and download bytes of every work to this csv',default=None)
+    parser.add_argument('--retry-file',type=str,help='where to write the works that were not ingested, continued in <retry file>.2 ... for large runs [default: ingest.retry]',default='ingest.retry')
+    parser.add_argument('--workers',type=int,help='split the file into shards and ingest them with this many processes at once',default=None)
+    parser.add_argument('--shards',type=int,help='number of shards to split the file into when using --workers [default: number of workers]',default=None)
+    parser.add_argument('--shard-by',choices=['range','hash'],help='split into shards by row ranges or by hash of the identifier [default: range]',default='range')
+    parser.add_argument('--shard-dir',type=str,help='directory to put shards in when using --workers, put it on a shared filesystem so other hosts can join with "python coordinator.py <shard dir>"',default=None)
     parser.add_argument('--print',type=int,help="how much of the log messages should be printed......"+\
         "\n1: status, errors, warnings, successful ingests, failed ingests, critical failurs, ending summary....\n"+\
         "2: everything but status............................\n"+\
         "3: just success and failues + summary and critiacal.\n4+: nothing but critical failues",default=1)
     args = parser.parse_args()
+    # after parsing so --help does not need config.py or truncate the logs
+    import config
+    logger.init('ingest.log','ingest_failures.log','ingest_status.log',truncate = True)
 
     logger.set_print_level(args.print)
     logger.status('Start of ingest {}'.format(args))
-    IngestFactory.create_controller(args,config).run_ingest_process()
+    if args.workers:
+        import coordinator
+        coordinator.run_coordinator(args)
+    else:
+        IngestFactory.create_controller(args,config).run_ingest_process()
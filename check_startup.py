@@ -0,0 +1,71 @@
+import sys
+import os
+import re
+import argparse
+import subprocess
+
+batch_loader_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'batch_loader.py')
+# modules only some ingests need: network, async, process pools, archives and hashing.
+# a submodule counts too, ie http.client for http
+deferred_modules = ('requests','urllib3','aiohttp','asyncio','socket','ssl','http','email',
+                    'concurrent.futures','multiprocessing','tarfile','zipfile','gzip','hashlib')
+
+def import_times(command):
+    """
+    Desc: runs a python command with -X importtime
+    Returns: touple of (dict of every module imported -> cumulative microseconds,
+        set of the modules imported directly, not by another module)
+    """
+    result = subprocess.run([sys.executable,'-X','importtime'] + command,
+                            stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(' '.join(command),result.stderr))
+    times, top_level = {}, set()
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|( *)(\S+)',line)
+        if match:
+            times[match.group(3)] = times.get(match.group(3),0) + int(match.group(1))
+            if len(match.group(2)) == 1: # one space means it was imported at the top level
+                top_level.add(match.group(3))
+    return times, top_level
+
+def is_deferred(module):
+    return any(module == name or module.startswith(name + '.') for name in deferred_modules)
+
+def check_startup(runs = 5):
+    """
+    Desc: imports batch_loader.py --help the way a cold start does, compared to python -c pass
+        so the modules python itself imports on startup are left out
+    Args: runs (int): how many times to measure, the fastest run is kept, the others are noise from the rest of the machine
+    Returns: touple of (list of deferred modules that were imported, dict of top level module name -> milliseconds of the fastest run)
+    """
+    interpreter, _ = import_times(['-c','pass'])
+    imported, best = set(), None
+    for _ in range(runs):
+        times, top_level = import_times([batch_loader_path,'--help'])
+        imported.update(name for name in times if name not in interpreter and is_deferred(name))
+        loader = {name : times[name] / 1000 for name in top_level if name not in interpreter}
+        if best is None or sum(loader.values()) < sum(best.values()):
+            best = loader
+    return sorted(imported), best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fails if batch_loader.py --help imports network, async or archive modules, '
+                                     'which should be imported where they are used, or if its imports take longer than the budget')
+    parser.add_argument('--budget',type=float,help='milliseconds allowed for imports beyond those of python -c pass [default: 60]',default=60)
+    parser.add_argument('--runs',type=int,help='how many times to measure, the fastest is used [default: 5]',default=5)
+    args = parser.parse_args()
+    imported, modules = check_startup(args.runs)
+    for name, ms in sorted(modules.items(), key=lambda item: -item[1])[:10]:
+        print('{:>8.1f} ms  {}'.format(ms,name))
+    total = sum(modules.values())
+    print('batch_loader.py --help imports took {:.1f} ms beyond python -c pass, budget is {:.1f} ms'.format(total,args.budget))
+    failed = False
+    if imported:
+        print('batch_loader.py --help imported {}, import them in the functions that use them'.format(', '.join(imported)))
+        failed = True
+    if total > args.budget:
+        print('startup budget exceeded, look for new imports at the top of a module that could be done where they are used')
+        failed = True
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,382 @@
+import sys
+import os
+import re
+import json
+import time
+import zlib
+import socket
+import shutil
+import tempfile
+import argparse
+import threading
+import subprocess
+from FormatLog import FormatLogger, write_line_to_file
+import manifest
+import failure_log
+from row_filter import get_shard_identifier, create_row_filter
+
+logger = FormatLogger()
+batch_loader_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'batch_loader.py')
+worker_args_file = 'worker_args.json' # written into the shard dir, tells joining hosts how to run the shards
+claim_file = 'claimed' # created in a shard dir by whoever is ingesting it, touched every heartbeat seconds while it runs
+done_file = 'done' # created in a shard dir when its ingest has finished, holds the return code
+log_names = ('ingest.log','ingest_failures.log','ingest_status.log')
+retry_file = 'ingest.retry'
+heartbeat = 30 # seconds between touches of the claim file of a running shard
+stale_after = 300 # seconds without a touch before a claim is taken to be from a host that died
+
+def assign_shards(rows,num_shards,shard_by,use_json):
+    """
+    Desc: decides which shard each row goes in, order within a shard is the order of the file
+    Args: rows (list): all the works in the file
+          num_shards (int): how many shards to split into
+          shard_by (str): 'range' for contiguous blocks of rows or 'hash' for a hash of the identifier
+          use_json (Boolean): if rows are from a json file rather than a csv
+    Returns: list of lists of rows, one list per shard
+    """
+    shards = [[] for _ in range(num_shards)]
+    if shard_by == 'hash':
+        for row in rows:
+            shard = zlib.crc32(get_shard_identifier(row,use_json).encode('utf-8')) % num_shards
+            shards[shard].append(row)
+    else:
+        size = -(-len(rows) // num_shards) # ceiling division
+        for n in range(num_shards):
+            shards[n] = rows[n*size:(n+1)*size]
+    return shards
+
+def split_manifest(file_path,use_json,num_shards,shard_by,shard_dir,parse_workers = None,row_filter = None):
+    """
+    Desc: splits the csv or json file into shards, each in its own directory inside shard_dir
+        only the rows chosen by row_filter (row_filter.RowFilter) are put in a shard
+    Returns: list of the paths to the shard directories (empty shards are not written)
+    """
+    if use_json:
+        with open(file_path) as jf:
+            rows = manifest.load_json_rows(jf)
+    else:
+        header, rows = manifest.read_csv_file(file_path,parse_workers)
+    if row_filter:
+        rows = row_filter.select(rows)
+    shard_paths = []
+    for n,shard_rows in enumerate(assign_shards(rows,num_shards,shard_by,use_json)):
+        if not shard_rows:
+            continue
+        shard_path = os.path.join(shard_dir,'shard_{:04d}'.format(n))
+        os.makedirs(shard_path,exist_ok=True)
+        if use_json:
+            with open(os.path.join(shard_path,'manifest.json'),'w') as jf:
+                json.dump(shard_rows,jf,indent=4)
+        else:
+            with open(os.path.join(shard_path,'manifest.csv'),'w') as csvfile:
+                manifest.write_csv_rows(csvfile,header,shard_rows)
+        shard_paths.append(shard_path)
+    logger.status('Split {} works from {} into {} shards in {}'.format(len(rows),file_path,len(shard_paths),shard_dir))
+    return shard_paths
+
+def worker_arguments(args):
+    """ the arguments for batch_loader.py that each shard should be run with """
+    worker_args = ['--worktype',args.worktype,'--print',str(args.print),
+                   '--base-dir',args.base_dir or os.path.dirname(os.path.abspath(args.file))]
+    if args.url:
+        worker_args.append('--url')
+    if args.json:
+        worker_args.append('--json')
+    if args.tiff:
+        worker_args.append('--tiff')
+    if args.debug:
+        worker_args.append('--debug')
+    if args.no_rate_control:
+        worker_args.append('--no-rate-control')
+    if args.collection:
+        worker_args += ['--collection',args.collection]
+    worker_args += ['--progress',str(args.progress),'--backend',args.backend,'--slow-percentile',str(args.slow_percentile),
+                    '--otherfiles',args.otherfiles]
+    if args.work_timeout:
+        worker_args += ['--work-timeout',str(args.work_timeout)]
+    if args.backend == 'http':
+        worker_args += ['--upload-workers',str(args.upload_workers)]
+        if args.ingest_url:
+            worker_args += ['--ingest-url',args.ingest_url]
+    if args.backend == 'simulated':
+        worker_args += ['--journal',os.path.abspath(args.journal),'--sim-speed',str(args.sim_speed),'--sim-seed',str(args.sim_seed)]
+    if args.backend == 'directory':
+        worker_args += ['--package-dir',os.path.abspath(args.package_dir)] # shards run in their own directory
+    # every worker gets an equal share of the disk and bandwidth limits
+    if args.max_disk:
+        worker_args += ['--max-disk',str(args.max_disk // args.workers)]
+    if args.max_rate:
+        worker_args += ['--max-rate',str(args.max_rate // args.workers)]
+    return worker_args
+
+def list_shards(shard_dir):
+    return sorted(os.path.join(shard_dir,name) for name in os.listdir(shard_dir) if name.startswith('shard_'))
+
+def claim_owner():
+    return '{}:{}:{}'.format(socket.gethostname(),os.getpid(),threading.get_ident())
+
+def claim_shard(shard_path):
+    """
+    Desc: atomically claims a shard by creating its claim file, so that only one process
+        on any host sharing the filesystem ingests it. a stale claim of a shard that is not done
+        is taken over, see is_stale()
+    Returns: True if this process now owns the shard
+    """
+    if os.path.exists(os.path.join(shard_path,done_file)):
+        return False
+    path = os.path.join(shard_path,claim_file)
+    try:
+        fd = os.open(path,os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not take_stale_claim(path):
+            return False
+        try: # the stale claim is gone, but another process may have claimed it since
+            fd = os.open(path,os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+    with os.fdopen(fd,'w') as claim:
+        claim.write(claim_owner() + '\n')
+    return True
+
+def is_stale(path):
+    """
+    Returns: True if the claim file at path belongs to a process that is gone: one on this host
+        that is no longer running, or one anywhere that has not touched it for stale_after seconds
+    """
+    try:
+        age = time.time() - os.stat(path).st_mtime
+        with open(path) as claim:
+            owner = claim.read().strip().split(':')
+    except FileNotFoundError:
+        return False
+    if len(owner) == 3 and owner[0] == socket.gethostname() and owner[1].isdigit():
+        try:
+            os.kill(int(owner[1]),0)
+        except ProcessLookupError:
+            return True
+        except PermissionError: # running as someone else
+            pass
+    return age > stale_after
+
+def take_stale_claim(path):
+    """
+    Desc: removes the claim file at path if it is stale. it is renamed out of the way first so that
+        of the processes finding the same stale claim only one removes it
+    Returns: True if the stale claim was removed
+    """
+    if not is_stale(path):
+        return False
+    aside = '{}.stale.{}'.format(path,claim_owner().replace(':','.'))
+    try:
+        os.rename(path,aside)
+    except FileNotFoundError: # another process got to it first
+        return False
+    if not is_stale(aside): # it was replaced by a fresh claim after we looked, put that back
+        try:
+            os.link(aside,path)
+        except FileExistsError:
+            pass
+        os.remove(aside)
+        return False
+    with open(aside) as claim:
+        owner = claim.read().strip()
+    os.remove(aside)
+    logger.warning('Taking over {} from {} which stopped ingesting it, works it already ingested may be ingested again'.format(
+        os.path.basename(os.path.dirname(path)),owner or 'a process that died while claiming it'))
+    return True
+
+def run_shard(shard_path,worker_args):
+    """ runs batch_loader.py on one shard with the shard dir as the cwd so its logs and ingest.retry stay in the shard.
+        on ctrl-c it still waits for batch_loader.py, which gets the ctrl-c too, to write its ingest.retry """
+    manifest_name = 'manifest.json' if '--json' in worker_args else 'manifest.csv'
+    logger.status('Starting',os.path.basename(shard_path),'on',socket.gethostname())
+    with open(os.path.join(shard_path,'worker.out'),'w') as out:
+        process = subprocess.Popen([sys.executable,batch_loader_path,manifest_name] + worker_args,
+                                   cwd=shard_path,stdout=out,stderr=subprocess.STDOUT)
+        interrupted = False
+        while True:
+            try:
+                returncode = process.wait(heartbeat)
+                break
+            except subprocess.TimeoutExpired:
+                try: # shows hosts waiting on this shard that it is still being ingested
+                    os.utime(os.path.join(shard_path,claim_file))
+                except FileNotFoundError:
+                    pass
+            except KeyboardInterrupt:
+                interrupted = True
+    with open(os.path.join(shard_path,done_file),'w') as done:
+        done.write(str(returncode))
+    logger.status('Finished',os.path.basename(shard_path),'return code',returncode)
+    if interrupted:
+        raise KeyboardInterrupt
+    return returncode
+
+def work_on_shards(shard_dir,stop = None):
+    """ claims and runs shards in shard_dir until there are none left to claim, including shards with stale claims,
+        or until stop (threading.Event) is set """
+    with open(os.path.join(shard_dir,worker_args_file)) as f:
+        worker_args = json.load(f)
+    for shard_path in list_shards(shard_dir):
+        if stop is not None and stop.is_set():
+            return
+        if claim_shard(shard_path):
+            run_shard(shard_path,worker_args)
+
+def run_workers(shard_dir,num_workers):
+    """ runs num_workers threads on this host, each running one batch_loader.py process at a time.
+        on ctrl-c no more shards are started, the running ones are waited for and KeyboardInterrupt is raised again
+    """
+    stop = threading.Event()
+    threads = [threading.Thread(target=work_on_shards,args=(shard_dir,stop)) for _ in range(num_workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        logger.status('Stopping, waiting for the running shards to write their retry files')
+        for thread in threads:
+            while thread.is_alive():
+                try:
+                    thread.join()
+                except KeyboardInterrupt: # leaving now would lose the works of the running shards
+                    pass
+        raise
+
+def wait_for_shards(shard_dir,poll = 5):
+    """ waits for shards claimed by other hosts to finish, ingesting them here if their host stops """
+    while True:
+        waiting = [path for path in list_shards(shard_dir) if not os.path.exists(os.path.join(path,done_file))]
+        if not waiting:
+            return
+        if any(is_stale(os.path.join(path,claim_file)) for path in waiting):
+            work_on_shards(shard_dir)
+        logger.status('Waiting on',len(waiting),'shards being ingested by other hosts:',
+                      ', '.join(os.path.basename(path) for path in waiting))
+        time.sleep(poll)
+
+def read_summary(shard_path):
+    """ Returns: touple of (number succeeded, number of works attempted) from the shards ingest.log """
+    path = os.path.join(shard_path,'ingest.log')
+    succeeded = total = 0
+    if os.path.exists(path):
+        with open(path) as log:
+            for line in log:
+                match = re.match(r'Succeeded on (\d+) out of (\d+) total',line)
+                if match:
+                    succeeded, total = int(match.group(1)), int(match.group(2))
+    return succeeded, total
+
+def merge_logs(shard_paths):
+    """ appends each shards logs to the logs of this run, in shard order """
+    for name, path in zip(log_names,(logger.logfile,logger.failure_file,logger.proccess_status)):
+        for shard_path in shard_paths:
+            shard_log = os.path.join(shard_path,name)
+            if not os.path.exists(shard_log):
+                continue
+            write_line_to_file(path,'---- {} ----'.format(os.path.basename(shard_path)))
+            with open(shard_log) as src, open(path,'a') as dest:
+                shutil.copyfileobj(src,dest)
+
+def read_shard_rows(shard_path,use_json):
+    """ Returns: the rows of the manifest of a shard """
+    if use_json:
+        with open(os.path.join(shard_path,'manifest.json')) as jf:
+            return manifest.load_json_rows(jf)
+    return manifest.read_csv_file(os.path.join(shard_path,'manifest.csv'))[1]
+
+def shard_failures(shard_path,use_json):
+    """
+    Returns: generator of (row, (identifier, error_class, retry_class, message)) for the works of a shard that were
+        not ingested: those in its retry file, or all of its works if it never finished (the run was stopped first)
+    """
+    shard_retry = os.path.join(shard_path,retry_file)
+    if os.path.exists(os.path.join(shard_path,done_file)):
+        if os.path.exists(shard_retry + '.report.csv'):
+            yield from failure_log.read_failures(shard_retry,use_json)
+        return
+    if os.path.exists(os.path.join(shard_path,claim_file)):
+        message = 'the run stopped while the shard was being ingested elsewhere, some of its works may have been ingested'
+    else:
+        message = 'the run stopped before the shard was started'
+    logger.warning('{} did not finish, adding all of its works to the retry file'.format(os.path.basename(shard_path)))
+    for row in read_shard_rows(shard_path,use_json):
+        yield row, (get_shard_identifier(row,use_json),'Interrupted','not attempted',message)
+
+def merge_retry_files(shard_paths,use_json,path = retry_file):
+    """
+    Desc: combines the retry files and failure reports of every shard into path in the cwd,
+        one part at a time so they are never all in memory
+    Returns: the list of retry file parts written
+    """
+    writer = None
+    for shard_path in shard_paths:
+        for row, reason in shard_failures(shard_path,use_json):
+            if writer is None:
+                writer = failure_log.FailureWriter(path,None if use_json else row.header)
+            writer.write(row,*reason)
+    return writer.close() if writer else []
+
+def merge_shards(shard_dir,use_json,worker_args,path = retry_file):
+    """ merges logs, results and retry files of all the shards into the cwd """
+    shard_paths = list_shards(shard_dir)
+    merge_logs(shard_paths)
+    num_success = num_total = 0
+    for shard_path in shard_paths:
+        if os.path.exists(os.path.join(shard_path,done_file)):
+            succeeded, total = read_summary(shard_path)
+        else: # stopped before it finished, all of its works go to the retry file
+            succeeded, total = 0, len(read_shard_rows(shard_path,use_json))
+        num_success += succeeded
+        num_total += total
+    logger.num_success = num_success
+    logger.num_fail = num_total - num_success
+    parts = merge_retry_files(shard_paths,use_json,path)
+    if parts:
+        logger.status("to run the ingest again on only the failed works use the following command{}:\n".format('s' if len(parts) > 1 else ''),
+                      '\n'.join("python batch_loader.py {} {}".format(part,' '.join(worker_args)) for part in parts))
+
+def run_coordinator(args):
+    """
+    Desc: splits args.file into shards, ingests them with args.workers processes on this host
+        (other hosts sharing the shard dir may join with "python coordinator.py <shard dir>"),
+        then merges the logs and ingest.retry files of every shard into the cwd
+    Args: args (argparse.Namespace): the arguments given to batch_loader.py
+    """
+    shard_dir = args.shard_dir or tempfile.mkdtemp(prefix='ingest_shards_',dir='.')
+    os.makedirs(shard_dir,exist_ok=True)
+    if os.listdir(shard_dir):
+        # the claims and done files of an earlier run would make its shards be skipped
+        logger.critical('The shard directory {} is not empty, remove it or give another --shard-dir'.format(shard_dir))
+        logger.close()
+        return
+    shard_dir = os.path.abspath(shard_dir)
+    worker_args = worker_arguments(args)
+    split_manifest(args.file,args.json,args.shards or args.workers,args.shard_by,shard_dir,args.parse_workers,
+                   create_row_filter(args))
+    with open(os.path.join(shard_dir,worker_args_file),'w') as f:
+        json.dump(worker_args,f)
+    logger.status('Other hosts can help with this ingest by running: python coordinator.py {}'.format(shard_dir))
+    try:
+        run_workers(shard_dir,args.workers)
+        wait_for_shards(shard_dir)
+    except KeyboardInterrupt:
+        logger.critical(KeyboardInterrupt)
+    merge_shards(shard_dir,args.json,worker_args,args.retry_file)
+    if not args.debug:
+        shutil.rmtree(shard_dir,ignore_errors=True)
+    logger.close()
+
+if __name__ == '__main__':
+    logger.init('ingest_worker.log','ingest_worker_failures.log','ingest_worker_status.log',truncate = True)
+    parser = argparse.ArgumentParser(description='Join an ingest started with batch_loader.py --workers from another host')
+    parser.add_argument('shard_dir', help='the shard directory printed by batch_loader.py, on a filesystem shared with that host')
+    parser.add_argument('--workers',type=int,help='how many shards to ingest at once on this host',default=1)
+    args = parser.parse_args()
+    try:
+        run_workers(args.shard_dir,args.workers)
+    except KeyboardInterrupt:
+        logger.critical(KeyboardInterrupt)
+    logger.close()
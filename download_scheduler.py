@@ -0,0 +1,125 @@
+import os
+import re
+import time
+import threading
+
+#keeps url ingests from filling the staging disk or saturating the network
+class Throttle():
+	""" token bucket shared by every download, limits the total download rate in bytes per second """
+	def __init__(self,rate):
+		self.rate = float(rate) # bytes per second
+		self.tokens = self.rate # allow a burst of one seconds worth
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def delay(self,size):
+		""" takes size bytes from the bucket, Returns: seconds the caller must wait before downloading more """
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+			self.last = now
+			self.tokens -= size
+			if self.tokens >= 0:
+				return 0
+			return -self.tokens / self.rate
+
+class DiskBudget():
+	""" caps the bytes downloaded but not yet cleaned up, counting both files being downloaded
+		(by their Content-Length) and files already on disk. a download waits until there is room,
+		unless nothing else is downloading, so one file bigger than the budget can still be ingested.
+	"""
+	def __init__(self,max_bytes):
+		self.max_bytes = max_bytes
+		self.used = 0 # bytes reserved by downloads in progress plus bytes of files on disk
+		self.downloading = 0 # number of downloads holding a reservation
+		self.files = {} # path -> bytes on disk
+		self.lock = threading.Lock()
+
+	def try_reserve(self,size):
+		with self.lock:
+			if self.used + size <= self.max_bytes or self.downloading == 0:
+				self.used += size
+				self.downloading += 1
+				return True
+			return False
+
+	def reserve(self,size):
+		""" blocks until size bytes can be downloaded """
+		while not self.try_reserve(size):
+			time.sleep(0.1)
+
+	async def reserve_async(self,size):
+		import asyncio # only needed by async downloads, which have already imported it
+		while not self.try_reserve(size):
+			await asyncio.sleep(0.1)
+
+	def commit(self,reserved,path,size):
+		""" a download has finished (or failed after writing size bytes to path) """
+		with self.lock:
+			self.used += size - reserved
+			self.downloading -= 1
+			self.files[os.path.abspath(path)] = self.files.get(os.path.abspath(path),0) + size
+
+	def release_dir(self,path):
+		""" the files under path have been deleted """
+		prefix = os.path.join(os.path.abspath(path),'')
+		with self.lock:
+			for file_path in [p for p in self.files if p.startswith(prefix)]:
+				self.used -= self.files.pop(file_path)
+
+class DownloadScheduler():
+	""" what every download of a run shares: the disk budget and the bandwidth throttle, either may be None """
+	def __init__(self,max_disk = None,max_rate = None):
+		self.budget = DiskBudget(max_disk) if max_disk else None
+		self.throttle = Throttle(max_rate) if max_rate else None
+		self.bytes_downloaded = 0
+		self.lock = threading.Lock()
+
+	def start(self,headers):
+		""" blocking, call once the response headers are in, Returns: the bytes reserved """
+		size = content_length(headers)
+		if self.budget:
+			self.budget.reserve(size)
+		return size
+
+	async def start_async(self,headers):
+		size = content_length(headers)
+		if self.budget:
+			await self.budget.reserve_async(size)
+		return size
+
+	def wrote(self,size):
+		""" Returns: seconds to wait after writing size bytes to stay under the bandwidth limit """
+		return self.throttle.delay(size) if self.throttle else 0
+
+	def finish(self,reserved,path,size):
+		with self.lock:
+			self.bytes_downloaded += size
+		if self.budget:
+			self.budget.commit(reserved,path,size)
+
+	def downloaded(self):
+		""" Returns: bytes downloaded so far """
+		return self.bytes_downloaded
+
+	def release_dir(self,path):
+		if self.budget:
+			self.budget.release_dir(path)
+
+def content_length(headers):
+	try:
+		return int(headers.get('Content-Length',0))
+	except ValueError:
+		return 0
+
+def parse_size(size):
+	"""
+	Desc: reads sizes given on the command line
+	Args: size (str): bytes with an optional K, M, G or T suffix ie '500M' or '2G'
+	Returns: the size in bytes (int)
+	"""
+	match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*',size,re.IGNORECASE)
+	if not match:
+		raise ValueError('could not understand size {}'.format(size))
+	number, unit = match.groups()
+	return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
@@ -8,4 +8,9 @@ debug_mode = False
 # set to True to use HTTP authentication for downloading files
 auth_enable = False
 auth_user = "username"
-auth_pass = "secret"
\ No newline at end of file
+auth_pass = "secret"
+
+# with --backend http, the url works are deposited to (--ingest-url overrides it)
+#ingest_url = "https://scholarspace.example.edu/api"
+# set to True to send auth_user and auth_pass when depositing with --backend http
+ingest_auth = False
@@ -0,0 +1,122 @@
+import os
+import csv
+import json
+from datetime import datetime
+from FormatLog import FormatLogger
+import manifest
+
+logger = FormatLogger()
+report_fields = ('part','identifier','error_class','retry_class','message')
+
+class FailureWriter():
+    """ writes works that were not ingested as soon as they fail, so a crash loses none of them and they are
+        never all held in memory. works go to retry files that batch_loader.py can read again
+        (csv with the original header, or json lines), started over in a new part when a part reaches max_bytes:
+        ingest.retry, ingest.retry.2, ingest.retry.3 ...
+        why each work failed goes to <path>.report.csv, counts of each kind of failure are logged on close()
+    """
+    def __init__(self,path = 'ingest.retry',header = None,max_bytes = 64 * 1024 * 1024,input_path = None):
+        """
+        Args: path (str): where to write the first part
+              header (manifest.CsvHeader): field names for csv retry files, None for json lines
+              max_bytes (int): size at which to start a new part
+              input_path (str): the file being ingested, never written over even if it is a retry file itself
+        """
+        if input_path and any(os.path.samefile(part,input_path) for part in find_parts(path)):
+            path = '{}.{}'.format(path,datetime.now().strftime('%Y%m%d%H%M%S'))
+        self.path = path
+        self.header = header
+        self.max_bytes = max_bytes
+        self.parts = [] # paths of the parts written so far
+        self.part = None # open file of the current part
+        self.writer = None # csv.writer of the current part
+        self.report = None # open report file
+        self.report_writer = None
+        self.counts = {} # (error class, retry class) -> number of works
+        self.total = 0
+
+    def part_path(self,n):
+        return self.path if n == 1 else '{}.{}'.format(self.path,n)
+
+    def open_part(self):
+        if self.part:
+            self.part.close()
+        path = self.part_path(len(self.parts) + 1)
+        self.part = open(path,'w',newline='' if self.header else None)
+        self.parts.append(path)
+        if self.header:
+            self.writer = csv.writer(self.part)
+            self.writer.writerow(self.header.field_names)
+
+    def open(self):
+        """ called on the first failure, removes the parts and report left by an earlier run """
+        for old in find_parts(self.path):
+            os.remove(old)
+        self.report = open(self.path + '.report.csv','w',newline='')
+        self.report_writer = csv.writer(self.report)
+        self.report_writer.writerow(report_fields)
+        self.open_part()
+
+    def write(self,row,identifier,error_class,retry_class,message):
+        """
+        Desc: records a work that was not ingested
+        Args: row: the work as it was read (manifest.CsvRow or dict from json)
+              identifier (str): what the work is called in the logs
+              error_class (str): name of the exception that stopped it
+              retry_class (str): what kind of failure it was, see retry_policy.py
+              message (str): the error message
+        """
+        if self.report is None:
+            self.open()
+        elif self.part.tell() >= self.max_bytes:
+            self.open_part()
+        if self.header:
+            self.writer.writerow(row.values)
+        else:
+            self.part.write(json.dumps(row) + '\n')
+        self.part.flush()
+        self.report_writer.writerow((os.path.basename(self.parts[-1]),identifier,error_class,retry_class,str(message)))
+        self.report.flush()
+        key = (error_class,retry_class)
+        self.counts[key] = self.counts.get(key,0) + 1
+        self.total += 1
+
+    def close(self):
+        """ closes the files and logs a summary, Returns: the list of parts written """
+        if self.part:
+            self.part.close()
+            self.report.close()
+        if self.total:
+            logger.status('{} works were not ingested, they are in {}'.format(self.total,', '.join(self.parts)))
+            for (error_class,retry_class), count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                logger.status('    {} {} ({})'.format(count,error_class,retry_class))
+            logger.status('why each work failed is in {}'.format(self.path + '.report.csv'))
+        return self.parts
+
+def find_parts(path):
+    """ Returns: the parts of a retry file in order, ie [ingest.retry, ingest.retry.2, ...] """
+    if not os.path.exists(path):
+        return []
+    parts = [path]
+    n = 2
+    while os.path.exists('{}.{}'.format(path,n)):
+        parts.append('{}.{}'.format(path,n))
+        n += 1
+    return parts
+
+def read_failures(path,use_json):
+    """
+    Desc: reads back what a FailureWriter wrote to path, one part at a time
+    Args: path (str): the path given to the FailureWriter
+          use_json (Boolean): if the parts are json lines rather than csv
+    Returns: generator of (row, (identifier, error_class, retry_class, message)) for each work in the parts
+    """
+    with open(path + '.report.csv',newline='') as report:
+        reasons = csv.reader(report)
+        next(reasons,None)
+        for part in find_parts(path):
+            with open(part,newline='') as f:
+                rows = manifest.load_json_rows(f) if use_json else manifest.read_csv_rows(f)[1]
+            for row in rows:
+                reason = next(reasons,None)
+                yield row, tuple(reason[1:]) if reason else (None,'','','')
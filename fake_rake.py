@@ -1,10 +1,56 @@
 #!/usr/local/bin/python3
-
+""" stand-in for the rake task, set ingest_command = "python fake_rake.py" in config.py.
+    on its own it fails half the works at random. given a journal (the --work-stats csv of a run,
+    see simulate.py) it replays it instead, taking as long as each work took and failing the attempts that failed:
+        ingest_command = "python /path/to/fake_rake.py --journal stats.csv --speed 10"
+"""
+import os
 import sys
+import json
+import time
+import zlib
 import random
+import argparse
+import tempfile
+
+def next_attempt(identifier):
+    """ counts the attempts at a work in a directory kept per batch_loader process, Returns: this attempt, from 1 """
+    directory = os.path.join(tempfile.gettempdir(),'fake_rake.{}'.format(os.getppid()))
+    os.makedirs(directory,exist_ok=True)
+    path = os.path.join(directory,'{:08x}'.format(zlib.crc32(identifier.encode('utf-8'))))
+    try:
+        with open(path) as f:
+            attempt = int(f.read()) + 1
+    except (OSError,ValueError):
+        attempt = 1
+    with open(path,'w') as f:
+        f.write(str(attempt))
+    return attempt
 
 if __name__ == '__main__':
     print(sys.argv, file=sys.stderr)
-    print(random.randint(1, 1000000))
-    if random.randint(0,1):
-    	exit(1)# failed ingest
+    # our own options come before the -- batch_loader puts in front of the rake task's
+    own, rake = (sys.argv[1:sys.argv.index('--')], sys.argv[sys.argv.index('--') + 1:]) if '--' in sys.argv else (sys.argv[1:], [])
+    parser = argparse.ArgumentParser(description='stand-in for the rake task')
+    parser.add_argument('--journal',type=str,help='the --work-stats csv of a run to replay',default=None)
+    parser.add_argument('--speed',type=float,help='replay this many times faster than recorded [default: 1]',default=1.0)
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args(own)
+    if '--otherfiles-tar=-' in rake:
+        while sys.stdin.buffer.read(1024 * 1024): # take the tar so batch_loader can finish sending it
+            pass
+    if not args.journal:
+        print(random.randint(1, 1000000))
+        if random.randint(0,1):
+            exit(1)# failed ingest
+        exit(0)
+    import simulate
+    options = dict(option[2:].split('=',1) for option in rake if option.startswith('--') and '=' in option)
+    with open(options['manifest']) as f:
+        identifier = simulate.work_identifier(json.load(f))
+    outcome = simulate.Replay(simulate.load_journal(args.journal),args.speed,args.seed).outcome(identifier,next_attempt(identifier))
+    time.sleep((outcome.tiff_seconds + outcome.import_seconds) / args.speed)
+    if outcome.error:
+        print('replayed', outcome.error, file=sys.stderr)
+        exit(1)# the rake task can only fail one way, whatever the recorded error was
+    print(random.Random(identifier).randint(1, 1000000))
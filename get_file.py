@@ -4,27 +4,115 @@ import time
 import json
 import subprocess
 import getpass
-from urllib.parse import unquote
+import functools
+import threading
+from urllib.parse import unquote, urlsplit
 import tempfile
-import xml.etree.ElementTree as xtree
-from lxml import etree
-import requests
-import validators
 from FormatLog import FormatLogger
+from retry_policy import RetryPolicy
 logger = FormatLogger()
+retry_policy = RetryPolicy()
+
+# requests, hashlib and work_stats are imported where they are used, so ingests from local files
+# (and batch_loader.py --help) do not pay for importing them
+url_file_name_pattern = re.compile(r'/([^/]+)/?$') # last part of the url, with or without a / at the end
+url_whitespace_pattern = re.compile(r'\s')
+# a filename= or filename*= parameter of a Content-Disposition header, quoted or not
+disposition_pattern = re.compile(r'filename(\*?)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;]*))', re.IGNORECASE)
+url_schemes = ('http','https','ftp')
 
 #written for WPI ingesting from URL
 class UrlException(ValueError):
 	pass
-def create_tiff_imagemagick(file):
+class ConnectionFailed(UrlException):
+	""" could not reach the server, worth trying again later """
+	transient = True
+class HttpError(UrlException):
+	""" the server answered with an error status """
+	def __init__(self,message,status_code,retry_after = None):
+		super().__init__(message)
+		self.status_code = status_code # http status code of the response
+		self.retry_after = retry_after # value of the Retry-After header if the server sent one
+class IncompleteDownload(UrlException):
+	""" fewer bytes arrived than the server said it would send, worth trying again later """
+	transient = True
+class ChecksumMismatch(UrlException):
+	""" the downloaded file does not match the checksum given in the metadata """
+	pass
+
+class Checksum():
+	""" md5 and sha256 of a file computed from the chunks as they are written, so the file is never read again """
+	def __init__(self):
+		import hashlib
+		self.md5 = hashlib.md5()
+		self.sha256 = hashlib.sha256()
+		self.size = 0
+	def update(self,chunk):
+		self.md5.update(chunk)
+		self.sha256.update(chunk)
+		self.size += len(chunk)
+	def digests(self):
+		return {'md5' : self.md5.hexdigest(), 'sha256' : self.sha256.hexdigest()}
+
+class FileNames():
+	""" the names of the files downloaded into one directory for a work. a url keeps the name it was given,
+		a different url with a name that is already taken gets _1, _2 ... before its extension so no file is overwritten
+	"""
+	def __init__(self):
+		self.names = {} # url -> name given to its file
+		self.taken = set()
+		self.lock = threading.Lock() # downloads may run in threads
+	def claim(self,url,file_name):
+		""" Returns: the name to save the file of url as """
+		with self.lock:
+			if url in self.names:
+				return self.names[url]
+			name, n = file_name, 0
+			root, ext = os.path.splitext(file_name)
+			while name in self.taken:
+				n += 1
+				name = '{}_{}{}'.format(root,n,ext)
+			self.taken.add(name)
+			self.names[url] = name
+			return name
+
+def check_content_length(headers,size,url):
+	""" raises IncompleteDownload if the number of bytes written is not the Content-Length the server sent """
+	length = headers.get('Content-Length')
+	if length is None or headers.get('Content-Encoding','identity') != 'identity':
+		return # compressed responses are decoded as they are written so the lengths wont match
+	if int(length) != size:
+		logger.error('expected {} bytes but got {} from {}'.format(length,size,url))
+		raise IncompleteDownload('download of {} ended after {} of {} bytes'.format(url,size,length))
+
+def verify_checksum(path,digests,expected):
+	"""
+	Desc: compares the digests of a downloaded file to a checksum from the metadata
+	Args: path (str): the file, for the error message
+		digests (dict): from Checksum.digests()
+		expected (str): 'md5:<hex>', 'sha256:<hex>' or just the hex, the algorithm is worked out from its length
+	"""
+	expected = expected.strip().lower()
+	if ':' in expected:
+		algorithm, expected = expected.split(':',1)
+	else:
+		algorithm = 'md5' if len(expected) == 32 else 'sha256'
+	if algorithm not in digests:
+		raise ChecksumMismatch('unsupported checksum algorithm {} for {}'.format(algorithm,path))
+	if digests[algorithm] != expected:
+		logger.error('{} checksum of {} is {} expected {}'.format(algorithm,path,digests[algorithm],expected))
+		raise ChecksumMismatch('{} checksum of {} does not match the metadata'.format(algorithm,path))
+def create_tiff_imagemagick(file,timeout = None):
 	"""
 	Desc:generates a tiff from the file given using image magick and subprocces
 	Args: file (str): path to file which a tiff should be generated for
+		timeout (float): Optional - seconds to let convert run before killing it
 	Returns: path to newly created tiff
 	"""
 	logger.info("creating tiff for",file,'...')
+	from work_stats import run_command
 	tiff = os.path.splitext(file)[0] + '.tiff'
-	return_code = subprocess.run(['convert',file,tiff], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+	run_command(['convert',file,tiff], timeout, check=False, stderr=subprocess.DEVNULL)
 	# if return_code != 0:
 	# 	raise Exception("non zero return code for image magick convert, if you are on windows this does not work.\ncommand:convert {} {}".format(file,tiff))
 	if os.path.exists(tiff):
@@ -46,26 +134,17 @@ def create_dir_for(files):
 		os.rename(path,os.path.join(tmpdir,file_name)) # move the file into the temporary dir basically mv(source=path,dest=tmpdir)
 	return tmpdir
 
+@functools.lru_cache(maxsize=100000)
 def get_file_name_from_url(url):
 	"""
 	Desc: finds the rightmost / and gets the rest of the url
 	ie www.blah.blah/blah/blah/file_name%20original.pdf => file_name%20original.pdf
 	use use urllib's unquote() to turn url encoding to normal chars like '%20' to ' '
+	remembered per url, works often share resources
 	"""
-	match = re.search("[/][^/]+[/]$",url)
-	if match:#Directory with / at the end
-		start = match.start() +1
-		end = match.end() -1
-		fileName = url[start:end]
-		fileName = unquote(fileName)
-		return fileName
-	match = re.search("[/][^/]+$",url)
+	match = url_file_name_pattern.search(url)
 	if match:
-		start = match.start() +1
-		end = match.end()
-		fileName = url[start:end]
-		fileName = unquote(fileName)
-		return fileName
+		return unquote(match.group(1))
 	logger.error('could not parse file name',url)
 	raise ValueError('unable to figure anything out whatso ever {} '.format(url))
 
@@ -82,94 +161,156 @@ def mv(path,new_path,args = None):
 		return
 	return subprocess.run(['sudo','mv',path,new_path]+args, stdout=subprocess.PIPE)
 
-def download_file(url, dwnld_dir=None, auth_enable=False, auth_user=None, auth_pass=None):
+def login(auth_user, auth_pass):
+	""" logs into eprojects to download restricted files
+	Returns: touple of (headers, cookies) to send with downloads
+	"""
+	login = {}
+	login['name'] = auth_user
+	login['pass'] = auth_pass
+	import requests
+	l = json.dumps(login)
+	req = requests.post("https://eprojects.wpi.edu/user/login?_format=json", data=l)
+	if req.status_code != 200:
+		raise HttpError('could not log in to download files code:{}'.format(req.status_code),req.status_code,req.headers.get('Retry-After'))
+	r_json = json.loads(req.text)
+	head = {}
+	head['X-CSRF-Token'] = r_json['csrf_token']
+	head['Content-Type'] = 'application/json'
+	return head, req.cookies.get_dict()
+
+def get_file_name_from_headers(headers):
+	""" Returns: the file name given in the Content-Disposition header, None if there is not one """
+	if 'content-disposition' in headers:
+		cont_disp = headers['content-disposition']
+	elif 'Content-Disposition' in headers:
+		cont_disp = headers['Content-Disposition']
+	else:
+		cont_disp = ""
+	return parse_content_disposition(cont_disp)
+
+def parse_content_disposition(cont_disp):
+	"""
+	Desc: gets the file name out of a Content-Disposition header value, filename*= (RFC 5987,
+		ie filename*=UTF-8''na%C3%AFve.pdf) is used over filename= when both are given.
+		any directories in the name are dropped so a server cant write outside the download dir
+	Returns: the file name or None
+	"""
+	file_name = None
+	for star, quoted, token in disposition_pattern.findall(cont_disp):
+		value = re.sub(r'\\(.)', r'\1', quoted) if quoted else token.strip()
+		if star:
+			charset, _, rest = value.partition("'")
+			_, _, encoded = rest.partition("'") # the language between the quotes is not needed
+			if encoded:
+				try:
+					file_name = unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+				except LookupError: # unknown charset
+					file_name = unquote(encoded, errors='replace')
+				break
+		elif file_name is None:
+			file_name = value
+	if file_name:
+		file_name = os.path.basename(file_name.replace('\\','/')).strip()
+	if not file_name or file_name in ('.','..'):
+		return None
+	return file_name
+
+def join_download_dir(dwnld_dir,file_name):
+	if dwnld_dir[-1] == '/':
+		return dwnld_dir+file_name
+	return dwnld_dir+'/'+file_name
+
+@functools.lru_cache(maxsize=100000)
+def is_valid_url(url):
+	""" Returns: True if url is an http(s) or ftp url with a host, checked once per url """
+	if url_whitespace_pattern.search(url):
+		return False
+	try:
+		parts = urlsplit(url)
+		parts.port # raises ValueError if the port is not a number
+	except ValueError:
+		return False
+	return parts.scheme.lower() in url_schemes and bool(parts.hostname)
+
+def validate_url(url):
+	if not is_valid_url(url):
+		logger.error('Invalid url: {}'.format(url))
+		raise UrlException('Invalid url: {}'.format(url))
+
+def download_file(url, dwnld_dir=None, auth_enable=False, auth_user=None, auth_pass=None, timeout=None, checksums=None, scheduler=None, names=None):
 	""" if the given url is valid and we have access to the file attached to it. this function
 	will download said file to the directory given or just put it in the current dir.
 	args:
 		url: the url
 		dwnld_dir: the path to dir to download to
+		timeout: seconds to wait for the server to connect or send data, None waits forever
+		checksums: (dict) optional, the md5 and sha256 of the file are stored in it under the returned path
+		scheduler: (download_scheduler.DownloadScheduler) optional, limits disk use and bandwidth
+		names: (FileNames) optional, names already given to other files in dwnld_dir, the file is renamed if its name is taken
 	"""
+	import requests
 	local_filename = get_file_name_from_url(url)
 	if dwnld_dir is not None:
-		if dwnld_dir[-1] == '/':
-			local_filename = dwnld_dir+local_filename
-		else:
-			local_filename = dwnld_dir+'/'+local_filename
+		local_filename = join_download_dir(dwnld_dir,local_filename)
 	else:# dwnld_dir is None
 		dwnld_dir = '.'
 	if not os.path.exists(dwnld_dir):
 		mkdir(dwnld_dir,['-p'])#make directory and make all directories that dont exist on the way
 	# NOTE the stream=True parameter
+	validate_url(url)
 	attempts = 0
 	while True:
 		attempts+=1
 		try:
-			if not validators.url(url.replace('[','B').replace(']','Be')):
-				logger.error('Invalid url: {}'.format(url))
-				raise UrlException('Invalid url: {}'.format(url))
-
 			if auth_enable:
-
-				# 1. login
-			  login = {}
-			  login['name'] = auth_user
-			  login['pass'] = auth_pass
-			  l = json.dumps(login)
-			  req = requests.post("https://eprojects.wpi.edu/user/login?_format=json", data=l)
-
-			  # 2. download
-			  auth = {}
-			  auth['head'] = {}
-			  auth['cookie'] = {}
-			  if req.status_code == 200:
-			    r_json = json.loads(req.text)
-			    auth['head']['X-CSRF-Token'] = r_json['csrf_token']
-			    auth['head']['Content-Type'] = 'application/json'
-			    auth['cookie'] = req.cookies.get_dict()
-			    r = requests.get(url, stream=True, headers=auth['head'], cookies=auth['cookie'])
-
+				head, cookies = login(auth_user, auth_pass)
+				r = requests.get(url, stream=True, headers=head, cookies=cookies, timeout=timeout)
 			else:
-				r = requests.get(url, stream=True)
+				r = requests.get(url, stream=True, timeout=timeout)
 
 			break
 
 		except requests.exceptions.ConnectionError as e:
 			logger.error('Can not connect...\n',e,'\n',url)
 			if attempts >=3:
-				raise UrlException('Could not connect to server to download file')
-			time.sleep(2)
+				raise ConnectionFailed('Could not connect to server to download file')
+			time.sleep(retry_policy.delay(e,attempts) or 0)
 
 	if 200 <= r.status_code <= 299:
 		try:
 			if logger.prints <2:
 				print('downloading file from {}'.format(url))
-			if 'content-disposition' in r.headers:
-				cont_disp = r.headers['content-disposition']
-			elif 'Content-Disposition' in r.headers:
-				cont_disp = r.headers['Content-Disposition']
-			else:
-				cont_disp = ""
-			url_filename = re.findall("filename=(.+)", cont_disp)
-			if url_filename and url_filename[0]:
-				fn = url_filename[0]
-				local_filename = fn.strip('"').strip()
-				if dwnld_dir[-1] == '/':
-					local_filename = dwnld_dir+local_filename # put it in download dir
-				else:
-					local_filename = dwnld_dir+'/'+local_filename # put it in download dir
-
-			with open(local_filename, 'wb') as f:
-				for chunk in r.iter_content(chunk_size=1024):
-					if chunk: # filter out keep-alive new chunks
-						f.write(chunk)
-						#f.flush() commented by recommendation from J.F.Sebastian
-			file_size = os.path.getsize(local_filename)
+			header_filename = get_file_name_from_headers(r.headers)
+			if header_filename:
+				local_filename = join_download_dir(dwnld_dir,header_filename) # put it in download dir
+			if names is not None:
+				local_filename = join_download_dir(dwnld_dir,names.claim(url,os.path.basename(local_filename)))
+
+			checksum = Checksum()
+			reserved = scheduler.start(r.headers) if scheduler else 0
+			try:
+				with open(local_filename, 'wb') as f:
+					for chunk in r.iter_content(chunk_size=64 * 1024):
+						if chunk: # filter out keep-alive new chunks
+							f.write(chunk)
+							checksum.update(chunk)
+							if scheduler:
+								time.sleep(scheduler.wrote(len(chunk)))
+							#f.flush() commented by recommendation from J.F.Sebastian
+			finally:
+				if scheduler:
+					scheduler.finish(reserved,local_filename,checksum.size)
+			file_size = checksum.size
 			if logger.prints <2:
 				print('done downloading %s' % (local_filename),"file size:",file_size)
 
 			if file_size == 0:
 				logger.error("file size is 0, file must not have downloaded correctly")
 				raise UrlException('Failed to downlaod')
+			check_content_length(r.headers,file_size,url)
+			if checksums is not None:
+				checksums[os.path.abspath(local_filename)] = checksum.digests()
 			return os.path.abspath(local_filename)
 		except PermissionError as e:
 			if dwnld_dir:
@@ -177,7 +318,7 @@ def download_file(url, dwnld_dir=None, auth_enable=False, auth_user=None, auth_p
 
 				if grant_access(dwnld_dir).returncode == 0:
 					print('success')
-					return download_file(url,dwnld_dir)
+					return download_file(url,dwnld_dir,auth_enable,auth_user,auth_pass,timeout,checksums,scheduler,names)
 			logger.error("could not acquire permission to download to target dir")
 			raise
 
@@ -188,7 +329,7 @@ def download_file(url, dwnld_dir=None, auth_enable=False, auth_user=None, auth_p
 		else:
 			text = r.text
 	logger.error('failed to download file error:{}, {}'.format(r.status_code,url))
-	raise UrlException('failed to download file.@{} code:{},body:{}'.format(url,r.status_code,text))
+	raise HttpError('failed to download file.@{} code:{},body:{}'.format(url,r.status_code,text),r.status_code,r.headers.get('Retry-After'))
 
 def mkdir(path,args = None):
 	if args is None:
@@ -199,3 +340,23 @@ def mkdir(path,args = None):
 	this_user = getpass.getuser()
 	subprocess.run(['sudo','mkdir','-m','775']+args+[path], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
 	return subprocess.run(['sudo','chown',this_user,path], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+if __name__ == '__main__':
+	# benchmark: python get_file.py [number of urls]
+	# validates and gets the file name of every url, most works share some resources so urls repeat
+	import sys
+	import random
+	num_urls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	unique = ['http://www.wpi.edu/Pubs/E-project/Available/E-project-{0}/unrestricted/File%20{0}.pdf'.format(n)
+		for n in range(num_urls // 10)]
+	urls = [random.choice(unique) for _ in range(num_urls)]
+	for name, validate, file_name in (('every time',is_valid_url.__wrapped__,get_file_name_from_url.__wrapped__),
+									('once per url',is_valid_url,get_file_name_from_url)):
+		is_valid_url.cache_clear()
+		get_file_name_from_url.cache_clear()
+		start = time.perf_counter()
+		for url in urls:
+			validate(url)
+			file_name(url)
+		seconds = time.perf_counter() - start
+		print('{:>13}: {} urls in {:.2f}s, {:.0f} urls/s'.format(name,num_urls,seconds,num_urls / seconds))
@@ -0,0 +1,302 @@
+import os
+import shutil
+import subprocess
+from work_stats import run_command, WorkTimeout
+from datetime import datetime
+from urllib.parse import quote
+from FormatLog import FormatLogger
+
+# tarfile, hashlib and concurrent.futures are imported where they are used,
+# so batch_loader.py --help and the rake backend do not pay for them
+logger = FormatLogger()
+backend_names = ('rake','http','directory','simulated')
+otherfiles_modes = ('args','list','tar') # how the rake and http backends pass the files after the first
+max_argument = 128 * 1024 # linux refuses to start a command with any one argument of more bytes than this, nul included (MAX_ARG_STRLEN)
+
+#where a work goes once its metadata and files are ready
+class IngestBackend():
+    """ puts one work into the repository, pick one per deployment with --backend """
+    def deposit(self,metadata_filepath,metadata,first_file,other_files,repository_id = None,timeout = None):
+        """
+        Desc: ingests one work
+        Args: metadata_filepath (str): path to the json file of the metadata
+              metadata (dict): the same metadata, already loaded
+              first_file (str): path to the primary file
+              other_files (list): paths to the rest of the files
+              repository_id (str): Optional - id of the work this updates, None for a new work
+              timeout (float): Optional - seconds left before the work times out, see work_stats.WorkMonitor
+        Returns: the id of the work in the repository
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """ called once after the last work """
+        pass
+
+class TarStream():
+    """ an uncompressed tar of some files, made as it is read so nothing is copied to disk first.
+        iterate over it for the bytes, len() is known up front so it can be sent with a Content-Length.
+        files are stored by their names without directories, a second file with the same name gets a number in front
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self,paths):
+        import tarfile
+        self.members = [] # (path, size, header bytes)
+        for path,name in zip(paths,unique_names(paths)):
+            stat = os.stat(path)
+            info = tarfile.TarInfo(name)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = 0o644
+            # pax headers keep long and non ascii names intact
+            self.members.append((path,stat.st_size,info.tobuf(tarfile.PAX_FORMAT,'utf-8','surrogateescape')))
+
+    def __len__(self):
+        import tarfile
+        return sum(len(header) + -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE for _, size, header in self.members) + 2 * tarfile.BLOCKSIZE
+
+    def __iter__(self):
+        import tarfile
+        for path, size, header in self.members:
+            yield header
+            remaining = size
+            with open(path,'rb') as f:
+                while remaining > 0:
+                    chunk = f.read(min(self.chunk_size,remaining))
+                    if not chunk:
+                        raise OSError('{} got shorter while it was being sent'.format(path))
+                    remaining -= len(chunk)
+                    yield chunk
+            if size % tarfile.BLOCKSIZE:
+                yield bytes(tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+        yield bytes(2 * tarfile.BLOCKSIZE) # end of archive
+
+class RakeBackend(IngestBackend):
+    """ runs the rake task given in config.py once per work, the way batch_loader has always ingested.
+        the other files are passed as the rake task chooses with otherfiles:
+            args  --otherfiles=<path>{|,|}<path>... (a file list is used instead if that would be too long to run)
+            list  --otherfiles-list=<file with one path per line>
+            tar   --otherfiles-tar=- with an uncompressed tar of the files on stdin
+    """
+    def __init__(self,ingest_command,ingest_path,ingest_depositor,worktype,collection = None,otherfiles = 'args'):
+        self.ingest_command = ingest_command # the command to execute the rake task - set in config.py
+        self.ingest_path = ingest_path # the directory of our rails project - set in config.py
+        self.ingest_depositor = ingest_depositor
+        self.worktype = worktype
+        self.collection = collection
+        self.otherfiles = otherfiles
+
+    def deposit(self,metadata_filepath,metadata,first_file,other_files,repository_id = None,timeout = None):
+        title = metadata.get('title')
+        logger.info('Importing', title)
+        # rake gwss:ingest_etd -- --manifest='path-to-manifest-json-file' --primaryfile='path-to-primary-attachment-file/myfile.pdf' --otherfiles='path-to-all-other-attachments-folder'
+        command = self.ingest_command.split(' ') + ['--',
+                                                    '--manifest=%s' % metadata_filepath,
+                                                    '--primaryfile=%s' % first_file,
+                                                    '--depositor=%s' % self.ingest_depositor,
+                                                    '--worktype=%s' % self.worktype]
+        if self.collection:
+            command += ['--collection=%s' % self.collection]
+        stdin_chunks = None
+        if other_files:
+            otherfiles = '{|,|}'.join(other_files) # our files have commas
+            if self.otherfiles == 'tar':
+                stdin_chunks = TarStream(other_files)
+                command.extend(['--otherfiles-tar=-'])
+            elif self.otherfiles == 'list' or len(('--otherfiles=' + otherfiles).encode('utf-8','surrogateescape')) + 1 > max_argument:
+                if self.otherfiles == 'args':
+                    logger.warning('{} has too many other files to pass on the command line, passing a list of them in --otherfiles-list'.format(title))
+                command.extend(['--otherfiles-list=%s' % write_file_list(other_files,os.path.dirname(metadata_filepath))])
+            else:
+                command.extend(['--otherfiles=%s' % otherfiles])
+        if repository_id:
+            logger.info('%s is an update.' % title)
+            command.extend(['--update-item-id=%s' % repository_id])
+        space = "\r" + ''.join([' ']*200)
+        logger.info(space+"\r\tCommand is: %s\n" % ' '.join(command))
+        if logger.prints < 3:
+            output = run_command(command,timeout,cwd=self.ingest_path,stdin_chunks=stdin_chunks)
+        else:
+            output = run_command(command,timeout,cwd=self.ingest_path,stderr=subprocess.DEVNULL,stdin_chunks=stdin_chunks)
+        repository_id = output.decode('utf-8').rstrip('\n')
+        logger.info('Repository id for',title,'is', repository_id)
+        return repository_id
+
+class HttpBackend(IngestBackend):
+    """ deposits works over http, SWORD style, without starting rails for every work:
+            POST <url>/works with the metadata json and In-Progress: true -> {"id": ...}
+            POST <url>/works/<id>/files with each file as the body, the files of a work upload at the same time
+            POST <url>/works/<id> with In-Progress: false once every file is in
+        connections are kept open between works. with otherfiles 'tar' the files after the first are sent
+        in one POST <url>/works/<id>/files?archive=tar of an uncompressed tar, one request for works with thousands of files.
+        see ingest_receiver.py for a stand-in server
+    """
+    def __init__(self,url,ingest_depositor,worktype,collection = None,auth = None,workers = 4,timeout = 300,otherfiles = 'args'):
+        import requests # only needed by this backend
+        from requests.adapters import HTTPAdapter
+        from concurrent.futures import ThreadPoolExecutor
+        self.url = url.rstrip('/')
+        self.params = {'depositor' : ingest_depositor, 'worktype' : worktype}
+        if collection:
+            self.params['collection'] = collection
+        self.timeout = timeout
+        self.otherfiles = otherfiles
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(pool_connections=1,pool_maxsize=workers)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def post(self,path,timeout = None,**kwargs):
+        from get_file import HttpError
+        r = self.session.post(self.url + path,timeout=min(self.timeout,timeout or self.timeout),**kwargs)
+        if not 200 <= r.status_code <= 299:
+            raise HttpError('ingest failed @{} code:{},body:{}'.format(self.url + path,r.status_code,r.text[:100]),
+                            r.status_code,r.headers.get('Retry-After'))
+        return r
+
+    def upload(self,work_id,path,primary,timeout = None):
+        headers = {'Content-Type' : 'application/octet-stream',
+                   'Content-Disposition' : "attachment; filename*=UTF-8''{}".format(quote(os.path.basename(path)))}
+        with open(path,'rb') as f:
+            self.post('/works/{}/files'.format(work_id),timeout,data=f,headers=headers,params={'primary' : 'true'} if primary else None)
+
+    def upload_archive(self,work_id,paths,timeout = None):
+        headers = {'Content-Type' : 'application/x-tar'}
+        self.post('/works/{}/files'.format(work_id),timeout,data=TarStream(paths),headers=headers,params={'archive' : 'tar'})
+
+    def deposit(self,metadata_filepath,metadata,first_file,other_files,repository_id = None,timeout = None):
+        from concurrent.futures import wait
+        logger.info('Depositing', metadata.get('title'),'to',self.url)
+        params = dict(self.params)
+        if repository_id:
+            params['update'] = repository_id
+        with open(metadata_filepath,'rb') as f:
+            r = self.post('/works',timeout,data=f,params=params,headers={'Content-Type' : 'application/json','In-Progress' : 'true'})
+        work_id = r.json()['id']
+        try:
+            if self.otherfiles == 'tar' and other_files:
+                uploads = [self.executor.submit(self.upload,work_id,first_file,True,timeout),
+                           self.executor.submit(self.upload_archive,work_id,list(other_files),timeout)]
+            else:
+                files = [first_file] + list(other_files)
+                uploads = [self.executor.submit(self.upload,work_id,path,n == 0,timeout) for n,path in enumerate(files)]
+            if wait(uploads,timeout).not_done:
+                for upload in uploads:
+                    upload.cancel()
+                raise WorkTimeout('the files of {} did not finish uploading in {:.0f} seconds'.format(work_id,timeout))
+            for upload in uploads:
+                upload.result() # raises the first error
+            self.post('/works/{}'.format(work_id),timeout,headers={'In-Progress' : 'false'})
+        except Exception:
+            try: # dont leave a half deposited work behind
+                self.session.delete('{}/works/{}'.format(self.url,work_id),timeout=self.timeout)
+            except Exception:
+                pass
+            raise
+        logger.info('Repository id for',metadata.get('title'),'is', work_id)
+        return work_id
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+class DirectoryBackend(IngestBackend):
+    """ dry run: writes each work as a bag-like package in package_dir instead of ingesting it,
+            <package_dir>/<id>/bagit.txt, bag-info.txt, metadata.json, manifest-sha256.txt and data/<files>
+        files are named in data/ like in a TarStream, they are hard linked into data/ when possible. useful to check a manifest
+        and to time the loader without a repository
+    """
+    def __init__(self,package_dir,ingest_depositor,worktype,collection = None):
+        self.package_dir = package_dir
+        self.bag_info = {'Depositor' : ingest_depositor, 'Work-Type' : worktype}
+        if collection:
+            self.bag_info['Collection'] = collection
+        os.makedirs(package_dir,exist_ok=True)
+
+    def deposit(self,metadata_filepath,metadata,first_file,other_files,repository_id = None,timeout = None):
+        work_id = repository_id or os.urandom(8).hex()
+        bag = os.path.join(self.package_dir,work_id)
+        data = os.path.join(bag,'data')
+        os.makedirs(data,exist_ok=True)
+        known = {f['file'] : f['sha256'] for f in metadata.get('fixity',[]) if 'sha256' in f} # from downloading, no need to read again
+        lines = []
+        paths = [first_file] + list(other_files)
+        names = unique_names(paths)
+        for path,name in zip(paths,names):
+            if name != os.path.basename(path): # the fixity of either file with this name could be the other's
+                known.pop(os.path.basename(path),None)
+        for path,name in zip(paths,names):
+            target = os.path.join(data,name)
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(path,target)
+            except OSError: # different filesystem or no hard link support
+                shutil.copy2(path,target)
+            lines.append('{}  data/{}\n'.format(known.get(name) or sha256_of(target),name))
+        shutil.copyfile(metadata_filepath,os.path.join(bag,'metadata.json'))
+        with open(os.path.join(bag,'manifest-sha256.txt'),'w') as f:
+            f.writelines(lines)
+        with open(os.path.join(bag,'bagit.txt'),'w') as f:
+            f.write('BagIt-Version: 1.0\nTag-File-Character-Encoding: UTF-8\n')
+        with open(os.path.join(bag,'bag-info.txt'),'w') as f:
+            info = dict(self.bag_info, **{'Bagging-Date' : datetime.now().strftime('%Y-%m-%d'), 'Primary-File' : os.path.basename(first_file)})
+            f.writelines('{}: {}\n'.format(key,value) for key,value in info.items())
+        logger.info('Packaged', metadata.get('title'),'in',bag)
+        return work_id
+
+def unique_names(paths):
+    """ Returns: the names of paths without directories, a second file with the same name gets its position in front """
+    names, seen = [], set()
+    for n,path in enumerate(paths):
+        name = os.path.basename(path)
+        if name in seen:
+            name = '{}_{}'.format(n,name)
+        seen.add(name)
+        names.append(name)
+    return names
+
+def write_file_list(paths,directory):
+    """ writes paths one per line (utf-8) to otherfiles.txt in directory, next to the metadata json so it is cleaned up with it
+        Returns: the path of the list """
+    list_path = os.path.join(directory,'otherfiles.txt')
+    with open(list_path,'w',encoding='utf-8',errors='surrogateescape') as f:
+        f.writelines(os.path.abspath(path) + '\n' for path in paths)
+    return list_path
+
+def sha256_of(path):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def create_backend(name,config,worktype,collection = None,ingest_url = None,package_dir = 'packages',workers = 4,otherfiles = 'args',
+                   journal = None,speed = 1.0,seed = 0,replay_downloads = False):
+    """
+    Desc: makes the backend chosen with --backend
+    Args: name (str): one of backend_names
+          config (module): config.py, ingest_command, ingest_path and ingest_depositor come from it,
+              and ingest_url for the http backend if not given
+          otherfiles (str): one of otherfiles_modes, how the rake and http backends pass the files after the first
+          journal (str): the --work-stats csv the simulated backend replays, see simulate.py for speed, seed and replay_downloads
+    Returns: IngestBackend
+    """
+    if name == 'http':
+        url = ingest_url or getattr(config,'ingest_url',None)
+        if not url:
+            raise ValueError('the http backend needs --ingest-url or ingest_url in config.py')
+        auth = (config.auth_user,config.auth_pass) if getattr(config,'ingest_auth',False) else None
+        return HttpBackend(url,config.ingest_depositor,worktype,collection,auth,workers,otherfiles=otherfiles)
+    if name == 'simulated':
+        import simulate # only needed for load tests
+        if not journal:
+            raise ValueError('the simulated backend needs --journal, the --work-stats csv of a run to replay')
+        return simulate.SimulatedBackend(simulate.Replay(simulate.load_journal(journal),speed,seed),replay_downloads)
+    if name == 'directory':
+        return DirectoryBackend(package_dir,config.ingest_depositor,worktype,collection)
+    return RakeBackend(config.ingest_command,config.ingest_path,config.ingest_depositor,worktype,collection,otherfiles)
@@ -0,0 +1,217 @@
+#!/usr/local/bin/python3
+""" stand-in for a repository that takes http deposits, for testing and timing batch_loader.py --backend http
+    without hyrax. start it, then ingest to it:
+        python ingest_receiver.py --port 8000 --dir received
+        python batch_loader.py example/example.csv --backend http --ingest-url http://127.0.0.1:8000
+    GET /files/<bytes>/<name> answers with that many bytes, for simulated --url downloads (see simulate.py)
+"""
+import os
+import sys
+import json
+import shutil
+import time
+import random
+import tarfile
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from get_file import parse_content_disposition
+
+class Receiver():
+    """ what the server remembers: works in progress, finished works and bytes received """
+    def __init__(self,directory = None,fail_rate = 0.0,latency = 0.0):
+        self.directory = directory # where to keep what is deposited, None to throw it away
+        self.fail_rate = fail_rate # share of requests answered with 503, to exercise retries
+        self.latency = latency # seconds to wait before answering each request
+        self.works = {} # id -> {'metadata': ..., 'files': [...], 'in_progress': Boolean}
+        self.completed = 0
+        self.bytes = 0
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def create(self,metadata,params):
+        with self.lock:
+            work_id = 'w{:08d}'.format(self.next_id)
+            self.next_id += 1
+            self.works[work_id] = {'metadata' : metadata, 'params' : params, 'files' : [], 'in_progress' : True}
+        if self.directory:
+            os.makedirs(os.path.join(self.directory,work_id),exist_ok=True)
+            with open(os.path.join(self.directory,work_id,'metadata.json'),'w') as f:
+                json.dump(metadata,f,indent=4)
+        return work_id
+
+    def stats(self):
+        with self.lock:
+            return {'works' : len(self.works), 'completed' : self.completed, 'bytes' : self.bytes}
+
+class BodyReader():
+    """ reads no more than the Content-Length of a request """
+    def __init__(self,rfile,length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self,size = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+def make_handler(receiver):
+    class DepositHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep connections open like a real server
+
+        def reply(self,status,body = None,headers = None):
+            data = json.dumps(body).encode('utf-8') if body is not None else b''
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key,value)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_body(self,out = None):
+            """ reads the request body into out (an open file) or throws it away, Returns: bytes read """
+            remaining = int(self.headers.get('Content-Length',0))
+            size = 0
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining,64 * 1024))
+                if not chunk:
+                    break
+                if out:
+                    out.write(chunk)
+                remaining -= len(chunk)
+                size += len(chunk)
+            return size
+
+        def read_archive(self,work_id):
+            """ unpacks an uncompressed tar request body as it arrives, Returns: list of (name, size) of its files """
+            body = BodyReader(self.rfile,int(self.headers.get('Content-Length',0)))
+            files = []
+            with tarfile.open(fileobj=body,mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    name = os.path.basename(member.name)
+                    if receiver.directory:
+                        with open(os.path.join(receiver.directory,work_id,name),'wb') as out:
+                            shutil.copyfileobj(tar.extractfile(member),out)
+                    files.append((name,member.size))
+            while body.read(64 * 1024): # padding after the end of the archive
+                pass
+            return files
+
+        def send_file(self,size,name):
+            self.send_response(200)
+            self.send_header('Content-Type','application/octet-stream')
+            self.send_header('Content-Disposition','attachment; filename="{}"'.format(name))
+            self.send_header('Content-Length',str(size))
+            self.end_headers()
+            block = bytes(64 * 1024)
+            while size > 0:
+                self.wfile.write(block[:size])
+                size -= len(block)
+
+        def unavailable(self):
+            """ answers 503 on some requests when --fail-rate is set, Returns: True if it did """
+            if receiver.latency:
+                time.sleep(receiver.latency)
+            if receiver.fail_rate and random.random() < receiver.fail_rate:
+                self.read_body()
+                self.reply(503,{'error' : 'try again later'},{'Retry-After' : '1'})
+                return True
+            return False
+
+        def do_GET(self):
+            parts = urlsplit(self.path).path.strip('/').split('/')
+            if parts == ['stats']:
+                self.reply(200,receiver.stats())
+            elif len(parts) == 3 and parts[0] == 'files' and parts[1].isdigit():
+                if not self.unavailable():
+                    self.send_file(int(parts[1]),parts[2])
+            else:
+                self.reply(404,{'error' : 'not found'})
+
+        def do_POST(self):
+            if self.unavailable():
+                return
+            url = urlsplit(self.path)
+            parts = url.path.strip('/').split('/')
+            params = {key : values[0] for key, values in parse_qs(url.query).items()}
+            if parts == ['works']:
+                try:
+                    metadata = json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))) or b'null')
+                except ValueError:
+                    return self.reply(400,{'error' : 'metadata is not json'})
+                if not isinstance(metadata,dict) or 'title' not in metadata:
+                    return self.reply(400,{'error' : 'metadata needs a title'})
+                self.reply(201,{'id' : receiver.create(metadata,params)})
+            elif len(parts) == 3 and parts[0] == 'works' and parts[2] == 'files' and parts[1] in receiver.works:
+                if params.get('archive') == 'tar':
+                    try:
+                        files = self.read_archive(parts[1])
+                    except tarfile.TarError as e:
+                        self.close_connection = True # the rest of the body was not read
+                        return self.reply(400,{'error' : 'bad tar: {}'.format(e)})
+                    with receiver.lock:
+                        receiver.works[parts[1]]['files'].extend({'name' : name, 'size' : size, 'primary' : False} for name, size in files)
+                        receiver.bytes += sum(size for _, size in files)
+                    return self.reply(201,{'files' : len(files), 'size' : sum(size for _, size in files)})
+                name = parse_content_disposition(self.headers.get('Content-Disposition','')) or 'file'
+                if receiver.directory:
+                    with open(os.path.join(receiver.directory,parts[1],name),'wb') as out:
+                        size = self.read_body(out)
+                else:
+                    size = self.read_body()
+                with receiver.lock:
+                    receiver.works[parts[1]]['files'].append({'name' : name, 'size' : size, 'primary' : params.get('primary') == 'true'})
+                    receiver.bytes += size
+                self.reply(201,{'name' : name, 'size' : size})
+            elif len(parts) == 2 and parts[0] == 'works' and parts[1] in receiver.works:
+                self.read_body()
+                with receiver.lock:
+                    work = receiver.works[parts[1]]
+                    if work['in_progress'] and self.headers.get('In-Progress','false').lower() == 'false':
+                        work['in_progress'] = False
+                        receiver.completed += 1
+                self.reply(200,{'id' : parts[1], 'files' : len(work['files'])})
+            else:
+                self.read_body()
+                self.reply(404,{'error' : 'not found'})
+
+        def do_DELETE(self):
+            parts = urlsplit(self.path).path.strip('/').split('/')
+            with receiver.lock:
+                work = receiver.works.pop(parts[1],None) if len(parts) == 2 and parts[0] == 'works' else None
+            if work and receiver.directory:
+                shutil.rmtree(os.path.join(receiver.directory,parts[1]),ignore_errors=True)
+            self.reply(204 if work else 404)
+
+        def log_message(self,*args):
+            pass # dont print every request
+    return DepositHandler
+
+def serve(port = 8000,directory = None,fail_rate = 0.0,latency = 0.0):
+    """ Returns: the started server (running in a background thread) and its Receiver """
+    receiver = Receiver(directory,fail_rate,latency)
+    server = ThreadingHTTPServer(('127.0.0.1',port),make_handler(receiver))
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server, receiver
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='stand-in http deposit server for batch_loader.py --backend http')
+    parser.add_argument('--port',type=int,default=8000)
+    parser.add_argument('--dir',type=str,help='keep deposited works here, by default they are thrown away',default=None)
+    parser.add_argument('--fail-rate',type=float,help='share of requests to answer with 503 Retry-After: 1 [default: 0]',default=0.0)
+    parser.add_argument('--latency',type=float,help='seconds to wait before answering each request [default: 0]',default=0.0)
+    args = parser.parse_args()
+    server, receiver = serve(args.port,args.dir,args.fail_rate,args.latency)
+    print('receiving deposits on http://127.0.0.1:{} (stats at /stats), ctrl-c to stop'.format(args.port),file=sys.stderr)
+    try:
+        while True:
+            time.sleep(10)
+            print(receiver.stats(),file=sys.stderr)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,222 @@
+import io
+import os
+import re
+import sys
+import csv
+import json
+import mmap
+import locale
+from collections.abc import Mapping
+
+class CsvHeader():
+    """ the field names of a csv, shared by every row read from that csv
+        so that each row only has to hold its values.
+    """
+    __slots__ = ('field_names','index')
+    def __init__(self,field_names):
+        self.field_names = tuple(field_names) # original field names, in order
+        self.index = {name : n for n,name in enumerate(self.field_names)} # field name -> position in a row
+
+    def __len__(self):
+        return len(self.field_names)
+
+    def row(self,values):
+        """
+        Desc: make a row from a list of values read from the csv, short rows are padded
+            with None and extra values are dropped (same as csv.DictReader with no restkey)
+        Args: values (list): the values of one line of the csv
+        Returns: CsvRow
+        """
+        width = len(self.field_names)
+        if len(values) < width:
+            values = values + [None] * (width - len(values))
+        elif len(values) > width:
+            values = values[:width]
+        return CsvRow(self,tuple(values))
+
+class CsvRow(Mapping):
+    """ a read only row of a csv backed by a tuple, can be used anywhere a
+        row from csv.DictReader was used ie row['title1'], row.get('first_file'), 'identifier1' in row
+    """
+    __slots__ = ('header','values')
+    def __init__(self,header,values):
+        self.header = header # CsvHeader shared by all rows of the csv
+        self.values = values # tuple of values in the same order as header.field_names
+
+    def __getitem__(self,field_name):
+        return self.values[self.header.index[field_name]]
+
+    def __contains__(self,field_name):
+        return field_name in self.header.index
+
+    def __iter__(self):
+        return iter(self.header.field_names)
+
+    def __len__(self):
+        return len(self.header.field_names)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def read_csv_rows(csvfile):
+    """
+    Desc: reads an open csv file, the first line being the field names
+    Args: csvfile (file): open csv file
+    Returns: touple of the CsvHeader and a list of CsvRow, blank lines are skipped
+    """
+    reader = csv.reader(csvfile)
+    try:
+        header = CsvHeader(next(reader))
+    except StopIteration:
+        return CsvHeader([]), []
+    return header, [header.row(values) for values in reader if values]
+
+def write_csv_rows(csvfile,header,rows):
+    """
+    Desc: writes the header and rows back out as a csv, the reverse of read_csv_rows
+    Args: csvfile (file): open file to write to
+          header (CsvHeader): the field names to write
+          rows (list): CsvRows that share the header
+    """
+    writer = csv.writer(csvfile)
+    writer.writerow(header.field_names)
+    for row in rows:
+        writer.writerow(row.values)
+
+# quoted values are found like csv.reader finds them: a " starts a quoted value only at the start of a field,
+# anywhere else it is a literal " (ie 5" floppy), and "" inside a quoted value is a literal "
+field_start = rb'(?:(?<=[,\r\n])|(?<![\s\S]))'
+literal_quote = rb'(?<=[^,\r\n])"'
+# whole fields and records up to endpos, a quoted value only counts as closed if something other than " follows
+# its closing ", so one cut off by endpos is never mistaken for closed. ends outside any quoted value
+whole_values = re.compile(rb'[^"]*(?:(?:' + field_start + rb'"[^"]*(?:""[^"]*)*"(?=[^"])|' + literal_quote + rb')[^"]*)*')
+# the rest of a record from outside a quoted value, ends at the newline ending it or the end of the file
+rest_of_record = re.compile(rb'(?:[^"\n]+|' + field_start + rb'"[^"]*(?:""[^"]*)*"?|' + literal_quote + rb')*')
+
+def find_record_boundaries(filepath,num_chunks):
+    """
+    Desc: finds where to split a csv so that no record is cut in half, a newline inside a quoted
+        value is not the end of a record
+    Args: filepath (str): path to the csv
+          num_chunks (int): about how many pieces to split it in
+    Returns: list of byte offsets starting with the end of the header and ending with the size of the file,
+        each piece is offsets[n]:offsets[n+1]
+    """
+    size = os.path.getsize(filepath)
+    if size == 0:
+        return [0]
+    targets = [0] + [size * n // num_chunks for n in range(1,num_chunks)] # first one finds the end of the header
+    offsets = []
+    position = 0 # always the start of a record
+    with open(filepath,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as data:
+        for target in targets:
+            if target > position:
+                position = whole_values.match(data,position,target).end()
+            position = rest_of_record.match(data,position).end() + 1
+            if position > size: # the last record has no newline
+                break
+            offsets.append(position)
+    if not offsets or offsets[-1] != size:
+        offsets.append(size)
+    return offsets
+
+def parse_csv_chunk(filepath,start,end,encoding):
+    """ reads the records between two offsets from find_record_boundaries, Returns: list of value lists, blank lines skipped """
+    with open(filepath,'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding)
+    return [values for values in csv.reader(io.StringIO(text,newline=None)) if values]
+
+def read_csv_file(filepath,workers = None,min_parallel_bytes = 64 * 1024 * 1024):
+    """
+    Desc: reads a csv like read_csv_rows, large files are split at record boundaries
+        and parsed by a pool of processes, the rows come back in the same order as the file
+    Args: filepath (str): path to the csv
+          workers (int): processes to parse with, 1 to parse here, None for one per cpu when the file is large
+          min_parallel_bytes (int): files smaller than this are parsed here unless workers is given
+    Returns: touple of the CsvHeader and a list of CsvRow
+    """
+    if workers is None:
+        workers = (os.cpu_count() or 1) if os.path.getsize(filepath) >= min_parallel_bytes else 1
+    if workers <= 1:
+        with open(filepath) as csvfile:
+            return read_csv_rows(csvfile)
+    from concurrent.futures import ProcessPoolExecutor # only needed for large files
+    encoding = locale.getpreferredencoding(False) # what open() would have used
+    offsets = find_record_boundaries(filepath,workers * 4) # more pieces than workers so a slow piece does not hold up the rest
+    header_values = parse_csv_chunk(filepath,0,offsets[0],encoding)
+    if not header_values:
+        return CsvHeader([]), []
+    header = CsvHeader(header_values[0])
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = executor.map(parse_csv_chunk,*zip(*[(filepath,start,end,encoding) for start,end in zip(offsets,offsets[1:])]))
+        for chunk in chunks:
+            rows.extend(header.row(values) for values in chunk)
+    return header, rows
+
+def load_json_rows(jsonfile):
+    """
+    Desc: reads the works from an open json file, either one json array of works
+        or json lines with one work per line like the ingest.retry of a json ingest
+    Args: jsonfile (file): open json file
+    Returns: list of dicts, one per work
+    """
+    text = jsonfile.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def measure_bytes_per_row(filepath):
+    """
+    Desc: loads the csv both as dicts and as CsvRows and reports the memory used per row by each
+    Args: filepath (str): path to the csv
+    Returns: touple of (bytes per dict row, bytes per CsvRow, number of rows)
+    """
+    import tracemalloc
+    tracemalloc.start()
+    with open(filepath) as csvfile:
+        before = tracemalloc.get_traced_memory()[0]
+        dict_rows = list(csv.DictReader(csvfile))
+        dict_bytes = tracemalloc.get_traced_memory()[0] - before
+    del dict_rows
+    with open(filepath) as csvfile:
+        before = tracemalloc.get_traced_memory()[0]
+        header, rows = read_csv_rows(csvfile)
+        compact_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    num_rows = max(len(rows),1)
+    return dict_bytes / num_rows, compact_bytes / num_rows, len(rows)
+
+def write_synthetic_csv(filepath,num_rows = 10000,num_columns = 200):
+    """ writes a csv shaped like our wide exports, used for benchmarking """
+    field_names = ['files','title1','creator1','resource_type1','license1'] + \
+        ['field{}_1'.format(n) for n in range(num_columns - 5)]
+    with open(filepath,'w') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(field_names)
+        for n in range(num_rows):
+            # most columns of an export are empty, a few are short values
+            writer.writerow(['file{}.pdf'.format(n),'title {}'.format(n),'creator','mqp',''] + \
+                ['v{}'.format(n) if c % 10 == 0 else '' for c in range(num_columns - 5)])
+
+if __name__ == '__main__':
+    # benchmark: python manifest.py [path to csv]
+    # with no csv given a 200 column csv is generated
+    import tempfile
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = os.path.join(tempfile.mkdtemp(),'synthetic.csv')
+        write_synthetic_csv(path)
+    dict_per_row, compact_per_row, num_rows = measure_bytes_per_row(path)
+    print('rows: {}'.format(num_rows))
+    print('dict rows:    {:.0f} bytes/row'.format(dict_per_row))
+    print('compact rows: {:.0f} bytes/row'.format(compact_per_row))
+    print('reduction:    {:.1f}x'.format(dict_per_row / max(compact_per_row,1)))
+    # parsing time with one process and with one per cpu
+    import time
+    for workers in sorted({1, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        read_csv_file(path,workers)
+        print('parse with {} process{}: {:.2f}s'.format(workers,'es' if workers > 1 else '',time.perf_counter() - start))
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import mmap
+import struct
+from collections.abc import Sequence
+import manifest
+
+magic = b'BLMANIFEST1\n'
+footer = struct.Struct('<Q') # length of the index json at the end of the file
+group_rows = 4096 # rows stored together, one row group is decoded at a time
+
+# a parsed manifest kept on disk so reruns of the same file do not parse it again.
+# rows are stored in row groups, and each group holds one json array per column
+# (or one array of the works for json manifests). a column that is the same for
+# every row of a group is stored once. the file is memory mapped and groups are
+# decoded as the rows are read, so a large manifest is never all in memory.
+class CachedRows(Sequence):
+    """ the rows of a cached manifest, can be used anywhere the list of rows was used.
+        close() or a with block unmaps the file
+    """
+    def __init__(self,path):
+        with open(path,'rb') as f: # the map stays valid after the file is closed
+            self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        index_length, = footer.unpack(self.map[-footer.size:])
+        self.index = json.loads(self.map[-footer.size - index_length:-footer.size])
+        self.header = manifest.CsvHeader(self.index['field_names']) if self.index['kind'] == 'csv' else None
+        self.num_rows = self.index['num_rows']
+        self.group_rows = self.index['group_rows']
+        self.cached_group = None # (group number, list of rows) of the last group decoded
+
+    def decode_column(self,location,size):
+        offset, length = location
+        values = json.loads(self.map[offset:offset + length])
+        if isinstance(values,dict): # stored once for the whole group
+            return [values['all']] * size
+        return values
+
+    def group(self,n):
+        """ Returns: the rows of row group n """
+        if self.cached_group is None or self.cached_group[0] != n:
+            size = min(self.group_rows,self.num_rows - n * self.group_rows)
+            columns = [self.decode_column(location,size) for location in self.index['groups'][n]]
+            if self.header:
+                rows = [manifest.CsvRow(self.header,values) for values in zip(*columns)]
+            else:
+                rows = columns[0]
+            self.cached_group = (n,rows)
+        return self.cached_group[1]
+
+    def column(self,field_name):
+        """ Returns: generator of one column of a csv manifest, without decoding the others """
+        column = self.header.index[field_name]
+        for n,locations in enumerate(self.index['groups']):
+            yield from self.decode_column(locations[column],min(self.group_rows,self.num_rows - n * self.group_rows))
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self[n] for n in range(*i.indices(self.num_rows))]
+        if i < 0:
+            i += self.num_rows
+        if not 0 <= i < self.num_rows:
+            raise IndexError('row {} is not in the manifest'.format(i))
+        return self.group(i // self.group_rows)[i % self.group_rows]
+
+    def __iter__(self):
+        for n in range(len(self.index['groups'])):
+            yield from self.group(n)
+
+    def __len__(self):
+        return self.num_rows
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+def encode_column(values):
+    if len(set(values)) == 1:
+        return json.dumps({'all' : values[0]}).encode('utf-8')
+    return json.dumps(values).encode('utf-8')
+
+def write_cache(path,source,kind,rows,header = None):
+    """
+    Desc: writes rows to a cache file, replacing it in one step so a crash never leaves half a cache
+    Args: path (str): the cache file
+          source (str): the manifest the rows came from, its size and mtime are recorded
+          kind (str): 'csv' or 'json'
+          rows (list): CsvRows sharing header, or dicts from a json manifest
+          header (manifest.CsvHeader): the header of a csv
+    """
+    stat = os.stat(source)
+    groups = []
+    temp = path + '.tmp'
+    with open(temp,'wb') as f:
+        f.write(magic)
+        for start in range(0,len(rows),group_rows):
+            group = rows[start:start + group_rows]
+            columns = zip(*(row.values for row in group)) if header else [group]
+            locations = []
+            for column in columns:
+                data = encode_column(list(column)) if header else json.dumps(column).encode('utf-8')
+                locations.append((f.tell(),len(data)))
+                f.write(data)
+            groups.append(locations)
+        index = json.dumps({'source' : os.path.abspath(source), 'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns,
+                            'kind' : kind, 'field_names' : list(header.field_names) if header else None,
+                            'num_rows' : len(rows), 'group_rows' : group_rows, 'groups' : groups}).encode('utf-8')
+        f.write(index)
+        f.write(footer.pack(len(index)))
+    os.replace(temp,path)
+
+def cache_path(cache_dir,source,kind):
+    """ the cache file for a manifest, named by a hash of its path """
+    import hashlib # only needed with --cache-dir
+    key = hashlib.sha1('{}:{}'.format(kind,os.path.abspath(source)).encode('utf-8')).hexdigest()[:20]
+    return os.path.join(cache_dir,key + '.manifest')
+
+def open_cache(path,source,kind):
+    """ Returns: CachedRows if the cache at path was made from source as it is now, otherwise None """
+    try:
+        with open(path,'rb') as f:
+            if f.read(len(magic)) != magic:
+                return None
+        rows = CachedRows(path)
+    except (OSError,ValueError,struct.error):
+        return None
+    stat = os.stat(source)
+    if (rows.index['size'],rows.index['mtime_ns'],rows.index['kind']) != (stat.st_size,stat.st_mtime_ns,kind):
+        rows.close()
+        return None
+    return rows
+
+def load_csv(filepath,cache_dir,workers = None):
+    """
+    Desc: reads a csv from the cache in cache_dir, parsing it and filling the cache if the csv is new or has changed
+    Returns: touple of the CsvHeader and the rows (CachedRows)
+    """
+    path = cache_path(cache_dir,filepath,'csv')
+    cached = open_cache(path,filepath,'csv')
+    if cached is None:
+        header, rows = manifest.read_csv_file(filepath,workers)
+        os.makedirs(cache_dir,exist_ok=True)
+        write_cache(path,filepath,'csv',rows,header)
+        del rows # read back from the cache so the parsed rows do not stay in memory
+        cached = open_cache(path,filepath,'csv')
+        if cached is None: # the csv changed while we were reading it
+            return manifest.read_csv_file(filepath,workers)
+    return cached.header, cached
+
+def load_json(filepath,cache_dir):
+    """ like load_csv for json manifests, Returns: the works (CachedRows, or a list of dicts if the file changed while reading it) """
+    path = cache_path(cache_dir,filepath,'json')
+    cached = open_cache(path,filepath,'json')
+    if cached is None:
+        with open(filepath) as jf:
+            rows = manifest.load_json_rows(jf)
+        os.makedirs(cache_dir,exist_ok=True)
+        write_cache(path,filepath,'json',rows)
+        cached = open_cache(path,filepath,'json')
+        if cached is None:
+            return rows
+    return cached
+
+if __name__ == '__main__':
+    # benchmark: python manifest_cache.py [path to csv]
+    # with no csv given a 200 column csv is generated
+    import time
+    import tempfile
+    import tracemalloc
+    cache_dir = tempfile.mkdtemp()
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = os.path.join(cache_dir,'synthetic.csv')
+        manifest.write_synthetic_csv(path,100000)
+    def load(name):
+        if name == 'parse':
+            return manifest.read_csv_file(path)
+        return load_csv(path,cache_dir)
+    for name in ('parse','first run, fills cache','cached'):
+        start = time.perf_counter()
+        header, rows = load(name)
+        loaded = time.perf_counter() - start
+        for row in rows:
+            row['title1']
+        total = time.perf_counter() - start
+        del header, rows
+        tracemalloc.start() # timed without tracemalloc, it slows everything down
+        header, rows = load('cached' if name == 'cached' else 'parse')
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del header, rows
+        print('{:<24} load {:.2f}s  load and iterate {:.2f}s  memory after load {:.0f}MB'.format(name,loaded,total,peak / 1024 / 1024))
+    print('cache file: {:.0f}MB, csv: {:.0f}MB'.format(os.path.getsize(cache_path(cache_dir,path,'csv')) / 1024 / 1024,
+                                                     os.path.getsize(path) / 1024 / 1024))
@@ -0,0 +1,184 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from FormatLog import FormatLogger
+
+logger = FormatLogger()
+latency_buckets = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600) # seconds, upper bounds of the histogram buckets
+
+class Histogram():
+    """ counts of how long a stage took, in the buckets prometheus expects (cumulative, le = upper bound) """
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self,seconds):
+        for n,bound in enumerate(latency_buckets):
+            if seconds <= bound:
+                self.counts[n] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += seconds
+        self.count += 1
+
+class Metrics():
+    """ live numbers about an ingest run: works/sec, bytes/sec, time spent in each stage, queue depths and an ETA.
+        shown as a progress line every interval seconds and optionally as a prometheus text file
+        or on http://127.0.0.1:<port>/metrics
+    """
+    def __init__(self,interval = 60,textfile = None):
+        self.interval = interval # seconds between progress lines, 0 or None for none
+        self.textfile = textfile # path to write prometheus metrics to, for node_exporter's textfile collector
+        self.start_time = None
+        self.total = 0 # works in the file
+        self.succeeded = 0
+        self.failed = 0
+        self.retrying = 0 # works waiting to be tried again
+        self.bytes_downloaded = lambda: 0 # set to a function returning the bytes downloaded so far
+        self.stages = {} # stage name -> Histogram
+        self.last_report = 0
+        self.lock = threading.Lock() # the http endpoint reads from another thread
+        self.server = None
+
+    def start(self,total):
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+        self.total = total
+
+    @contextmanager
+    def time(self,stage):
+        """ with metrics.time('download'): ... records how long the block took under stage """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages.setdefault(stage,Histogram()).observe(time.monotonic() - start)
+
+    def stage_seconds(self):
+        """ Returns: dict of stage -> total seconds spent in it so far """
+        with self.lock:
+            return {stage : histogram.sum for stage, histogram in self.stages.items()}
+
+    def work_finished(self,succeeded,retrying):
+        """ a work succeeded or failed for good, retrying is how many works are waiting to be tried again """
+        with self.lock:
+            if succeeded:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self.retrying = retrying
+        self.report()
+
+    def work_deferred(self,retrying):
+        with self.lock:
+            self.retrying = retrying
+        self.report()
+
+    def report(self,force = False):
+        """ prints the progress line and writes the text file if interval seconds have passed """
+        now = time.monotonic()
+        if not force and (not self.interval or now - self.last_report < self.interval):
+            return
+        self.last_report = now
+        line = self.progress_line()
+        if logger.prints <= 3: # shown at the same print levels as successes and failures
+            print(line)
+        logger.write(line)
+        if self.textfile:
+            self.write_textfile()
+
+    def elapsed(self):
+        return max(time.monotonic() - self.start_time, 1e-9) if self.start_time else 1e-9
+
+    def eta(self):
+        """ Returns: seconds until every work has been tried, None if nothing is done yet """
+        done = self.succeeded + self.failed
+        if not done:
+            return None
+        return (self.total - done) * self.elapsed() / done
+
+    def progress_line(self):
+        done = self.succeeded + self.failed
+        elapsed = self.elapsed()
+        eta = self.eta()
+        return '[{}/{} {:.0f}%] succeeded {} failed {} retrying {} | {:.2f} works/s {:.2f} MB/s | ETA {}'.format(
+            done, self.total, 100.0 * done / max(self.total,1), self.succeeded, self.failed, self.retrying,
+            done / elapsed, self.bytes_downloaded() / elapsed / 1024 / 1024,
+            format_seconds(eta) if eta is not None else '?')
+
+    def prometheus_text(self):
+        """ Returns: the metrics in the prometheus text exposition format """
+        with self.lock:
+            done = self.succeeded + self.failed
+            lines = [
+                '# HELP batch_loader_works_total works in the file being ingested',
+                '# TYPE batch_loader_works_total gauge',
+                'batch_loader_works_total {}'.format(self.total),
+                '# HELP batch_loader_works_finished works ingested or failed for good',
+                '# TYPE batch_loader_works_finished counter',
+                'batch_loader_works_finished{{result="success"}} {}'.format(self.succeeded),
+                'batch_loader_works_finished{{result="failure"}} {}'.format(self.failed),
+                '# HELP batch_loader_queue_depth works waiting, by queue',
+                '# TYPE batch_loader_queue_depth gauge',
+                'batch_loader_queue_depth{{queue="remaining"}} {}'.format(self.total - done),
+                'batch_loader_queue_depth{{queue="retrying"}} {}'.format(self.retrying),
+                '# HELP batch_loader_downloaded_bytes bytes downloaded',
+                '# TYPE batch_loader_downloaded_bytes counter',
+                'batch_loader_downloaded_bytes {}'.format(self.bytes_downloaded()),
+                '# HELP batch_loader_works_per_second works finished per second since the start',
+                '# TYPE batch_loader_works_per_second gauge',
+                'batch_loader_works_per_second {:.6f}'.format(done / self.elapsed()),
+                '# HELP batch_loader_eta_seconds estimated seconds until every work has been tried',
+                '# TYPE batch_loader_eta_seconds gauge',
+                'batch_loader_eta_seconds {:.0f}'.format(self.eta() or 0),
+                '# HELP batch_loader_stage_seconds time spent in each stage of ingesting a work',
+                '# TYPE batch_loader_stage_seconds histogram',
+            ]
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(latency_buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('batch_loader_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage,bound,cumulative))
+                lines.append('batch_loader_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(stage,histogram.sum))
+                lines.append('batch_loader_stage_seconds_count{{stage="{}"}} {}'.format(stage,histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        """ writes the metrics to self.textfile, replacing it in one step so readers never see half a file """
+        temp = self.textfile + '.tmp'
+        with open(temp,'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp,self.textfile)
+
+    def serve(self,port):
+        """ serves the metrics on http://127.0.0.1:port/metrics from a background thread, only reachable from this host """
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type','text/plain; version=0.0.4')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self,*args):
+                pass # dont print every scrape
+        self.server = HTTPServer(('127.0.0.1',port),MetricsHandler)
+        thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+        thread.start()
+        logger.status('Serving metrics on http://127.0.0.1:{}/metrics'.format(port))
+
+    def stop(self):
+        self.report(force = bool(self.interval) or bool(self.textfile))
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
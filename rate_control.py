@@ -0,0 +1,104 @@
+import time
+from collections import deque
+from FormatLog import FormatLogger
+from retry_policy import RetryPolicy, NETWORK, THROTTLED, SERVER
+
+logger = FormatLogger()
+
+class RateController():
+    """ paces calls to the ingest backend (the rake task) so we dont knock over hyrax/solr/fedora.
+        the pause between imports is changed multiplicatively both ways: every healthy import shrinks it to a fraction
+        of itself, every slow import or congestion failure (network errors, timeouts, http 429 and 5xx) doubles it.
+        an import is slow if it took much longer than the median of the recent ones for the size of its files,
+        so a large work taking long is not mistaken for the backend slowing down.
+        failures that say nothing about the backend's load (bad metadata, missing files, http 4xx) leave the
+        pause alone. a burst of congestion failures in a row stops the ingest for a backoff period that doubles
+        with each burst.
+        with --workers every process has its own controller, like tcp they back off independently
+        and converge on a share of what the backend can take.
+    """
+    def __init__(self,step = 0.25,recovery = 0.8,max_interval = 60,latency_factor = 3.0,burst = 5,burst_pause = 10,max_pause = 600,retry_policy = None,
+                 window = 50,min_samples = 5,size_unit = 1024 * 1024):
+        self.step = step # shortest pause in seconds, a healthy import taking it below this ends the pause
+        self.recovery = recovery # the pause is multiplied by this after a healthy import (increase of rate)
+        self.max_interval = max_interval # longest pause between imports in seconds
+        self.latency_factor = latency_factor # an import is slow if its cost is this many times the median cost
+        self.size_unit = size_unit # bytes, the cost of an import is its latency per size_unit of files, for works larger than that
+        self.min_samples = min_samples # healthy imports to see before calling any slow
+        self.costs = deque(maxlen=window) # cost of the latest healthy imports
+        self.burst = burst # how many failures in a row count as a burst
+        self.burst_pause = burst_pause # seconds to pause after the first burst, doubles every burst after
+        self.max_pause = max_pause # longest pause after a burst in seconds
+        self.retry_policy = retry_policy or RetryPolicy() # classifies failures, only congestion slows the pace
+        self.interval = 0.0 # current pause between the start of imports
+        self.latency = None # moving average of import latency
+        self.failures_in_a_row = 0
+        self.bursts = 0 # bursts since the last success
+        self.last_start = None
+        self.imports = 0
+        self.failures = 0
+
+    def wait(self):
+        """ blocks until the next import is allowed to start """
+        if self.last_start is not None and self.interval > 0:
+            remaining = self.last_start + self.interval - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+        self.last_start = time.monotonic()
+
+    def record(self,latency,succeeded,error = None,size = 0):
+        """
+        Desc: adjusts the pace from how an import went
+        Args: latency (float): seconds the import took
+              succeeded (Boolean): if the backend accepted the work
+              error (Exception): Optional - what a failed import raised, without it the failure counts as congestion
+              size (int): Optional - bytes of the files of the work
+        """
+        self.imports += 1
+        if not succeeded:
+            self.failures += 1
+            if error is not None and not self.congestion(error):
+                # the backend answered, the work itself was bad. its latency says nothing about the load either
+                return
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if succeeded:
+            self.failures_in_a_row = 0
+            self.bursts = 0
+            cost = latency / max(1.0,size / self.size_unit)
+            slow = len(self.costs) >= self.min_samples and cost > self.latency_factor * median(self.costs)
+            self.costs.append(cost)
+            if slow:
+                self.slow_down()
+            else:
+                self.interval *= self.recovery
+                if self.interval < self.step:
+                    self.interval = 0.0
+            return
+        self.failures_in_a_row += 1
+        self.slow_down()
+        if self.failures_in_a_row >= self.burst:
+            self.back_off()
+
+    def congestion(self,error):
+        """ Returns: True if error means the backend is overloaded or unreachable, rather than the work being bad """
+        return getattr(error,'timed_out',False) or self.retry_policy.classify(error) in (NETWORK,THROTTLED,SERVER)
+
+    def slow_down(self):
+        """ multiplicative decrease of the rate """
+        self.interval = min(self.max_interval, max(self.interval * 2, self.step))
+
+    def back_off(self):
+        """ pauses the ingest after a burst of failures """
+        self.bursts += 1
+        self.failures_in_a_row = 0
+        pause = min(self.max_pause, self.burst_pause * 2 ** (self.bursts - 1))
+        logger.warning('{} imports failed in a row, pausing for {} seconds before trying again'.format(self.burst,pause))
+        time.sleep(pause)
+
+    def summary(self):
+        return 'imports: {} failed: {} average latency: {:.2f}s pause between imports: {:.2f}s'.format(
+            self.imports,self.failures,self.latency or 0.0,self.interval)
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
@@ -0,0 +1,83 @@
+import time
+import random
+import subprocess
+
+# error classes, what kind of failure an exception represents
+NETWORK = 'network' # could not connect, connection reset, timeouts
+THROTTLED = 'throttled' # http 429 or 503, the server asked us to slow down
+SERVER = 'server' # other http 5xx
+INGEST = 'ingest' # the rake task exited non zero
+PERMANENT = 'permanent' # bad metadata, missing files, http 4xx, retrying will not help
+
+class RetryPolicy():
+    """ decides which failures are worth retrying and how long to wait before trying again.
+        waits are exponential with full jitter so works that failed together dont retry together.
+    """
+    def __init__(self,base_delay = 2,max_delay = 300,max_attempts = None,seed = None):
+        self.base_delay = base_delay # seconds, the longest wait before the second attempt
+        self.max_delay = max_delay # seconds, the longest wait before any attempt
+        self.max_attempts = { # attempts including the first one, per error class
+            NETWORK : 4,
+            THROTTLED : 6,
+            SERVER : 4,
+            INGEST : 2, # the rake task also fails on bad metadata, so only try once more
+            PERMANENT : 1,
+        }
+        if max_attempts:
+            self.max_attempts.update(max_attempts)
+        self.random = random.Random(seed) # jitter, seeded by load tests so every replay waits the same
+
+    def classify(self,error):
+        """
+        Desc: works out what kind of failure an exception is
+        Args: error (Exception): what was raised while ingesting a work
+        Returns: (str) one of NETWORK, THROTTLED, SERVER, INGEST, PERMANENT
+        """
+        status_code = getattr(error,'status_code',None)
+        if status_code is not None:
+            if status_code in (429,503):
+                return THROTTLED
+            if status_code >= 500:
+                return SERVER
+            return PERMANENT
+        if isinstance(error,subprocess.CalledProcessError):
+            return INGEST
+        if isinstance(error,(ConnectionError,TimeoutError)) or getattr(error,'transient',False):
+            return NETWORK
+        if type(error).__module__.split('.')[0] in ('requests','urllib3','aiohttp'):
+            # the http libraries wrap socket errors in their own exception types
+            return NETWORK
+        return PERMANENT
+
+    def delay(self,error,attempt):
+        """
+        Desc: how long to wait before trying a work again
+        Args: error (Exception): what the last attempt raised
+              attempt (int): how many attempts have been made so far, starting at 1
+        Returns: seconds to wait, or None if the work should not be tried again
+        """
+        error_class = self.classify(error)
+        if attempt >= self.max_attempts[error_class]:
+            return None
+        wait = self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = parse_retry_after(getattr(error,'retry_after',None))
+        if retry_after is not None:
+            wait = max(wait, min(retry_after, self.max_delay))
+        return wait
+
+def parse_retry_after(value):
+    """
+    Desc: reads an http Retry-After header, which is either seconds or a date
+    Returns: seconds to wait (float) or None if there is no usable header
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import mmap
+import zlib
+import argparse
+from collections.abc import Sequence
+
+# picks out some of the works of a manifest without editing it:
+#   --rows 100:200  --ids a,b,c  --match title1=^Annual  --shard 2/8
+# every filter given must match. rows are checked one at a time as they are read
+# (from the memory mapped cache with --cache-dir), only the numbers of the selected rows are kept
+class SelectedRows(Sequence):
+    """ the selected rows of a manifest, in the order of the file, used in place of the list of all rows """
+    def __init__(self,rows,numbers):
+        self.rows = rows # all the rows, a list or manifest_cache.CachedRows
+        self.numbers = numbers # row numbers of the selected rows, a range or a list
+        self.header = getattr(rows,'header',None)
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self.rows[n] for n in self.numbers[i]]
+        return self.rows[self.numbers[i]]
+
+    def __len__(self):
+        return len(self.numbers)
+
+class RowFilter():
+    def __init__(self,row_range = None,identifiers = None,matches = None,shard = None,shard_by = 'range',use_json = False):
+        """
+        Args: row_range (tuple): (start, end) row numbers counting from 0 like a python slice, either may be None
+              identifiers (set): identifiers (or titles, when there is no identifier) of the works to keep
+              matches (list): (field name, compiled regex) pairs, the value of the field must match
+              shard (tuple): (i, N) keep only shard i of N, shards are split like coordinator.py splits them
+              shard_by (str): 'range' or 'hash', see coordinator.assign_shards
+              use_json (Boolean): if the rows are from a json file
+        """
+        self.row_range = row_range
+        self.identifiers = identifiers
+        self.matches = matches or []
+        self.shard = shard
+        self.shard_by = shard_by
+        self.use_json = use_json
+
+    def __bool__(self):
+        """ False if no filter was given and every row is kept """
+        return bool(self.row_range or self.identifiers is not None or self.matches or self.shard)
+
+    def candidates(self,num_rows):
+        """ Returns: range of the row numbers allowed by --rows and a --shard by range """
+        start, end, _ = slice(*(self.row_range or (None,None))).indices(num_rows)
+        numbers = range(start,max(start,end))
+        if self.shard and self.shard_by == 'range':
+            i, num_shards = self.shard
+            size = -(-num_rows // num_shards) # ceiling division, the same as coordinator.assign_shards
+            numbers = range(max(numbers.start,i * size),min(numbers.stop,(i + 1) * size))
+        return numbers
+
+    def keep(self,row,check_identifiers = True):
+        """ Returns: True if the row passes the filters that have to look at it """
+        if self.shard and self.shard_by == 'hash':
+            i, num_shards = self.shard
+            if zlib.crc32(get_shard_identifier(row,self.use_json).encode('utf-8')) % num_shards != i:
+                return False
+        if check_identifiers and self.identifiers is not None and row_identifier(row,self.use_json) not in self.identifiers:
+            return False
+        for field_name, pattern in self.matches:
+            values = row.get(field_name)
+            if not isinstance(values,list):
+                values = [values]
+            if not any(pattern.search(str(value)) for value in values if value is not None):
+                return False
+        return True
+
+    def select(self,rows,index = None):
+        """
+        Desc: finds the rows that pass every filter
+        Args: rows (list or manifest_cache.CachedRows): every row of the manifest
+              index (IdentifierIndex): Optional - identifier -> list of row numbers, from identifier_index()
+                  so --ids only reads the rows asked for
+        Returns: SelectedRows
+        """
+        numbers = self.candidates(len(rows))
+        check_identifiers = self.identifiers is not None and index is None
+        if self.identifiers is not None and index is not None:
+            numbers = sorted(n for identifier in self.identifiers for n in index.get(identifier,()) if n in numbers)
+        if self.matches or check_identifiers or (self.shard and self.shard_by == 'hash'):
+            numbers = [n for n in numbers if self.keep(rows[n],check_identifiers)]
+        return SelectedRows(rows,numbers)
+
+def get_shard_identifier(row,use_json):
+    """ the same identifier batch_loader logs works by, used to hash works into shards """
+    if use_json:
+        identifier = row.get('identifier') or row.get('title')
+    else:
+        identifier = row.get('identifier1') or row.get('title1')
+    return str(identifier)
+
+def row_identifier(row,use_json):
+    """ the identifier (or title) of a work as written in --ids, the first one if a json work has a list """
+    if use_json:
+        identifier = row.get('identifier') or row.get('title')
+        if isinstance(identifier,list):
+            identifier = identifier[0] if identifier else None
+    else:
+        identifier = row.get('identifier1') or row.get('title1')
+    return '' if identifier is None else str(identifier)
+
+class IdentifierIndex():
+    """ identifier -> row numbers, kept in a file as sorted lines of <json identifier>\t<row number>
+        after a first line recording the size and mtime of the manifest. looked up by binary search
+        on the memory mapped file, so finding 100 works among a million reads a few pages, not the whole index
+    """
+    def __init__(self,path):
+        self.file = open(path,'rb')
+        self.map = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        self.start = self.map.find(b'\n') + 1 # where the sorted lines begin
+        self.info = json.loads(self.map[:self.start])
+
+    def get(self,identifier,default = ()):
+        key = json.dumps(identifier).encode('utf-8')
+        lo, hi = self.start, len(self.map)
+        while lo < hi: # find the first line with a key >= key
+            line = max(self.map.rfind(b'\n',self.start,(lo + hi) // 2) + 1,self.start)
+            if self.map[line:self.map.find(b'\t',line)] < key:
+                lo = self.map.find(b'\n',line) + 1
+            else:
+                hi = line
+        numbers = []
+        while lo < len(self.map):
+            tab = self.map.find(b'\t',lo)
+            end = self.map.find(b'\n',tab)
+            if self.map[lo:tab] != key:
+                break
+            numbers.append(int(self.map[tab + 1:end]))
+            lo = end + 1
+        return numbers or default
+
+def identifier_index(rows,source,path,use_json):
+    """
+    Desc: opens the identifier index kept at path, making it if it is missing or source has changed since
+    Args: rows: every row of the manifest
+          source (str): the manifest, its size and mtime are recorded in the index
+          path (str): where to keep the index, next to the manifest cache
+    Returns: IdentifierIndex
+    """
+    stat = os.stat(source)
+    try:
+        index = IdentifierIndex(path)
+        if (index.info['size'],index.info['mtime_ns']) == (stat.st_size,stat.st_mtime_ns):
+            return index
+    except (OSError,ValueError,KeyError):
+        pass
+    if not use_json and hasattr(rows,'column'): # read only the columns we need from the cache
+        if 'identifier1' in rows.header.index:
+            names = (identifier or title for identifier, title in zip(rows.column('identifier1'),rows.column('title1')))
+        else:
+            names = rows.column('title1')
+    else:
+        names = (row_identifier(row,use_json) for row in rows)
+    lines = sorted((json.dumps('' if identifier is None else str(identifier)).encode('utf-8'),n) for n,identifier in enumerate(names))
+    temp = path + '.tmp'
+    with open(temp,'wb') as f:
+        f.write(json.dumps({'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns}).encode('utf-8') + b'\n')
+        f.writelines(b'%s\t%d\n' % line for line in lines)
+    os.replace(temp,path)
+    return IdentifierIndex(path)
+
+def parse_row_range(text):
+    """ reads --rows START:END, either may be left out ie 100: or :50 """
+    start, sep, end = text.partition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError('--rows should be START:END, ie 100:200')
+    return (int(start) if start.strip() else None, int(end) if end.strip() else None)
+
+def parse_shard(text):
+    """ reads --shard I/N, I counts from 0 """
+    i, sep, num_shards = text.partition('/')
+    i, num_shards = int(i), int(num_shards)
+    if not sep or not 0 <= i < num_shards:
+        raise argparse.ArgumentTypeError('--shard should be I/N with 0 <= I < N, ie 2/8')
+    return i, num_shards
+
+def parse_match(text):
+    """ reads --match FIELD=REGEX """
+    field_name, sep, pattern = text.partition('=')
+    if not sep or not field_name:
+        raise argparse.ArgumentTypeError('--match should be FIELD=REGEX, ie title1=^Annual')
+    try:
+        return field_name, re.compile(pattern)
+    except re.error as e:
+        raise argparse.ArgumentTypeError('bad regex in --match {}: {}'.format(text,e))
+
+def parse_identifiers(text):
+    """ reads --ids, identifiers separated by commas or @file with one identifier per line """
+    if text.startswith('@'):
+        with open(text[1:]) as f:
+            return {line.strip() for line in f if line.strip()}
+    return {identifier.strip() for identifier in text.split(',') if identifier.strip()}
+
+def create_row_filter(args):
+    """ Returns: the RowFilter for the --rows, --ids, --match and --shard arguments of batch_loader.py (already parsed by the functions above) """
+    return RowFilter(args.rows,args.ids,args.match,args.shard,args.shard_by,args.json)
@@ -0,0 +1,102 @@
+import os
+import shutil
+from FormatLog import FormatLogger
+
+logger = FormatLogger()
+
+class SharedResources():
+    """ urls listed by more than one work (shared appendices, licenses, cover images) are downloaded
+        once into cache_dir and hard linked into the directory of every work that lists them.
+        a cached file is deleted once the last work that lists it is done.
+    """
+    def __init__(self,cache_dir):
+        self.cache_dir = cache_dir
+        self.uses = {} # url -> number of works still to be ingested that list it
+        self.paths = {} # url -> path of the downloaded file in cache_dir
+        self.checksums = {} # path in cache_dir -> md5 and sha256 from download
+        self.links = {} # url -> number of times it has been linked into a work
+        self.bytes_saved = 0 # bytes we did not download because the url was already cached
+        self.downloads_saved = 0
+
+    @staticmethod
+    def work_urls(row):
+        """ Returns: the set of urls a work downloads """
+        urls = set()
+        if row.get('fulltext_url'):
+            urls.add(row['fulltext_url'])
+        for url in row.get('resources') or []:
+            urls.add(url)
+        return urls
+
+    def count(self,rows):
+        """ counts how many works list each url, call once with all the works before ingesting any """
+        uses = {}
+        for row in rows:
+            for url in self.work_urls(row):
+                uses[url] = uses.get(url,0) + 1
+        self.uses = {url : n for url, n in uses.items() if n > 1}
+        if self.uses:
+            logger.status('{} urls are listed by more than one work and will be downloaded once'.format(len(self.uses)))
+
+    def is_shared(self,url):
+        return url in self.uses
+
+    def download(self,urls,download_all,**kwargs):
+        """
+        Desc: downloads the shared urls that are not cached yet at the same time, each into its own directory
+            in the cache so files with the same name from different urls dont collide
+        Args: urls (list): shared urls a work needs
+              download_all (function): async_download.download_all
+              kwargs: passed to download_all
+        """
+        import hashlib # only needed with --url, where it is imported anyway by the downloads
+        missing = [url for url in dict.fromkeys(urls) if url not in self.paths]
+        if not missing:
+            return
+        url_dirs = [os.path.join(self.cache_dir,hashlib.sha1(url.encode('utf-8')).hexdigest()) for url in missing]
+        for url_dir in url_dirs:
+            os.makedirs(url_dir,exist_ok=True)
+        checksums = {}
+        self.paths.update(zip(missing,download_all(missing,url_dirs,checksums=checksums,**kwargs)))
+        self.checksums.update(checksums)
+
+    def link(self,url,proj_dir,checksums = None,names = None):
+        """
+        Desc: puts the cached file for url into proj_dir, as a hard link or a copy if linking is not possible
+        Args: names (get_file.FileNames): Optional - names of the other files in proj_dir, renames the link if its name is taken
+        Returns: the path of the file in proj_dir
+        """
+        cached = self.paths[url]
+        name = os.path.basename(cached)
+        path = os.path.join(proj_dir,names.claim(url,name) if names is not None else name)
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(cached,path)
+        except OSError: # different filesystem or no hard link support
+            shutil.copy2(cached,path)
+        self.links[url] = self.links.get(url,0) + 1
+        if self.links[url] > 1:
+            self.bytes_saved += os.path.getsize(cached)
+            self.downloads_saved += 1
+        if checksums is not None and cached in self.checksums:
+            checksums[os.path.abspath(path)] = self.checksums[cached]
+        return os.path.abspath(path)
+
+    def done(self,row,scheduler = None):
+        """ a work will not be tried again, deletes the cached files no other work needs """
+        for url in self.work_urls(row):
+            if url not in self.uses:
+                continue
+            self.uses[url] -= 1
+            if self.uses[url] <= 0:
+                del self.uses[url]
+                cached = self.paths.pop(url,None)
+                if cached:
+                    self.checksums.pop(cached,None)
+                    shutil.rmtree(os.path.dirname(cached),ignore_errors=True)
+                    if scheduler:
+                        scheduler.release_dir(os.path.dirname(cached))
+
+    def summary(self):
+        return 'shared urls downloaded once: saved {} downloads and {:.1f} MB'.format(self.downloads_saved,self.bytes_saved / 1024 / 1024)
@@ -0,0 +1,208 @@
+#!/usr/local/bin/python3
+""" replays a recorded run against a simulated repository, for load tests that come out the same every time.
+    the journal is the csv batch_loader.py --work-stats writes: for every attempt at every work the
+    download, tiff and import seconds, the bytes downloaded and what kind of failure it was, if any.
+    --backend simulated sleeps for the recorded time of each work (divided by --sim-speed) and fails
+    the attempts that failed, the same way, so the retry policy treats them the same. works that are not
+    in the journal borrow the outcomes of a recorded work picked by hashing their identifier, so a journal
+    of 1000 works can drive a run of 100000.
+
+        python simulate.py journal stats.csv --works 1000 --fail-rate 0.5    (a made up journal, if there is no recorded run)
+        python simulate.py manifest stats.csv sim.csv --works 100000
+        python batch_loader.py sim.csv --backend simulated --journal stats.csv --sim-speed 100 --progress 10
+
+    with --url, make the manifest with --url http://127.0.0.1:8000 and start ingest_receiver.py on that port,
+    the works then download the recorded number of bytes from it. fake_rake.py replays a journal
+    from inside the rake task, to include the cost of starting a process for every work.
+"""
+import os
+import sys
+import csv
+import math
+import time
+import zlib
+import random
+import argparse
+import subprocess
+from collections import namedtuple
+import retry_policy
+from work_stats import WorkTimeout, stages
+from ingest_backend import IngestBackend
+from FormatLog import FormatLogger
+
+logger = FormatLogger()
+Outcome = namedtuple('Outcome',['error','retry_class','downloaded_bytes'] + [stage + '_seconds' for stage in stages])
+
+class ReplayedError(Exception):
+    """ a failure recorded in the journal, with the status_code or transient flag retry_policy looks for """
+    pass
+
+def load_journal(path):
+    """
+    Desc: reads a --work-stats csv
+    Returns: dict of identifier -> list of Outcome, one per attempt in order
+    """
+    journal = {}
+    with open(path,newline='') as f:
+        for line in csv.DictReader(f):
+            error = line['error']
+            retry_class = line.get('retry_class') # older stats files only have the name of the error
+            if error and not retry_class:
+                retry_class = retry_policy.INGEST if error == 'CalledProcessError' else retry_policy.PERMANENT
+            seconds = {stage + '_seconds' : float(line.get(stage + '_seconds') or 0) for stage in stages}
+            if 'import_seconds' not in line:
+                seconds['import_seconds'] = float(line['wall_seconds'])
+            outcome = Outcome(error=error,retry_class=retry_class,downloaded_bytes=int(line['downloaded_bytes'] or 0),**seconds)
+            journal.setdefault(line['identifier'],[]).append((int(line['attempt']),outcome))
+    return {identifier : [outcome for _, outcome in sorted(attempts)] for identifier, attempts in journal.items()}
+
+class Replay():
+    """ what happens to each attempt at each work, from a journal """
+    def __init__(self,journal,speed = 1.0,seed = 0):
+        if not journal:
+            raise ValueError('the journal has no works in it')
+        self.journal = journal
+        self.identifiers = sorted(journal)
+        self.speed = speed # recorded seconds are divided by this
+        self.seed = seed # picks which recorded work a new identifier borrows from, and seeds the retry waits
+
+    def outcome(self,identifier,attempt):
+        """ Returns: the Outcome of attempt (counting from 1) at the work, the last recorded one past the recorded attempts """
+        attempts = self.journal.get(identifier)
+        if attempts is None:
+            key = zlib.crc32('{}:{}'.format(self.seed,identifier).encode('utf-8')) % len(self.identifiers)
+            attempts = self.journal[self.identifiers[key]]
+        return attempts[min(attempt,len(attempts)) - 1]
+
+def replayed_error(outcome):
+    """ Returns: an exception retry_policy classifies the way the recorded failure was, None if it succeeded """
+    if not outcome.error:
+        return None
+    if outcome.retry_class == retry_policy.INGEST:
+        return subprocess.CalledProcessError(1,['replayed',outcome.error])
+    error = ReplayedError('replayed {} ({} error)'.format(outcome.error,outcome.retry_class))
+    if outcome.retry_class == retry_policy.THROTTLED:
+        error.status_code = 503
+    elif outcome.retry_class == retry_policy.SERVER:
+        error.status_code = 500
+    elif outcome.retry_class == retry_policy.NETWORK:
+        error.transient = True
+    return error
+
+def work_identifier(metadata):
+    """ the identifier batch_loader logs a work by (and the journal records it by), from its metadata """
+    identifier = metadata.get('identifier') or metadata.get('title')
+    if isinstance(identifier,list):
+        identifier = identifier[0] if identifier else None
+    return str(identifier)
+
+class SimulatedBackend(IngestBackend):
+    """ --backend simulated, takes as long as the recorded work did and fails the way it did.
+        the tiff time is included since --tiff is not used when replaying, the download time only
+        with replay_downloads, when nothing is being downloaded for real
+    """
+    def __init__(self,replay,replay_downloads = False):
+        self.replay = replay
+        self.replay_downloads = replay_downloads
+        self.attempts = {} # identifier -> attempts so far
+        self.deposits = 0
+        self.simulated = 0.0 # seconds slept
+        self.started = None
+
+    def deposit(self,metadata_filepath,metadata,first_file,other_files,repository_id = None,timeout = None):
+        if self.started is None:
+            self.started = time.monotonic()
+        identifier = work_identifier(metadata)
+        attempt = self.attempts[identifier] = self.attempts.get(identifier,0) + 1
+        outcome = self.replay.outcome(identifier,attempt)
+        seconds = outcome.tiff_seconds + outcome.import_seconds
+        if self.replay_downloads:
+            seconds += outcome.download_seconds
+        seconds /= self.replay.speed
+        self.deposits += 1
+        if timeout is not None and seconds > timeout:
+            self.simulated += timeout
+            time.sleep(timeout)
+            raise WorkTimeout('replayed work took longer than the {:.1f} seconds it had left'.format(timeout))
+        self.simulated += seconds
+        time.sleep(seconds)
+        error = replayed_error(outcome)
+        if error:
+            raise error
+        logger.info('Replayed', identifier, 'attempt', attempt)
+        return 'sim{:08x}'.format(zlib.crc32(identifier.encode('utf-8')))
+
+    def close(self):
+        if not self.deposits:
+            return
+        wall = time.monotonic() - self.started
+        logger.status('replayed {} deposits in {:.1f}s ({:.0f} an hour), {:.1f}s of it simulated repository time, loader overhead {:.2f}ms per deposit'.format(
+            self.deposits,wall,self.deposits / wall * 3600 if wall else 0,self.simulated,(wall - self.simulated) / self.deposits * 1000))
+
+def write_journal(path,works,fail_rate = 0.5,import_seconds = 2.0,downloaded_bytes = 1024 * 1024,seed = 0):
+    """
+    Desc: makes up a journal when there is no recorded run to replay. import times and download sizes
+        are log normal around the given medians, every attempt fails with the rake task exiting non zero
+        at fail_rate, like fake_rake.py has always done, until the retry policy would give up
+    """
+    rand = random.Random(seed)
+    max_attempts = retry_policy.RetryPolicy().max_attempts[retry_policy.INGEST]
+    with open(path,'w',newline='') as f:
+        writer = csv.DictWriter(f,fieldnames=['identifier','attempt','result','error','retry_class','wall_seconds','downloaded_bytes'] + \
+                                [stage + '_seconds' for stage in stages])
+        writer.writeheader()
+        for n in range(works):
+            size = int(rand.lognormvariate(math.log(downloaded_bytes),1.0))
+            for attempt in range(1,max_attempts + 1):
+                seconds = rand.lognormvariate(math.log(import_seconds),0.5)
+                failed = rand.random() < fail_rate
+                writer.writerow({'identifier' : 'sim{:07d}'.format(n), 'attempt' : attempt, 'result' : 'failure' if failed else 'success',
+                                 'error' : 'CalledProcessError' if failed else '', 'retry_class' : retry_policy.INGEST if failed else '',
+                                 'wall_seconds' : '{:.3f}'.format(seconds), 'downloaded_bytes' : size,
+                                 'download_seconds' : 0, 'tiff_seconds' : 0, 'import_seconds' : '{:.3f}'.format(seconds)})
+                if not failed:
+                    break
+
+def write_manifest(path,replay,works = None,url = None):
+    """
+    Desc: writes a csv manifest of works to replay, the works of the journal first then made up ones
+    Args: works (int): how many works, the number in the journal by default
+          url (str): Optional - the ingest_receiver.py to download from, each work downloads its recorded bytes
+    """
+    works = len(replay.identifiers) if works is None else works
+    sample = os.path.join(os.path.dirname(os.path.abspath(path)),'simulated.pdf')
+    with open(sample,'wb') as f:
+        f.write(b'%PDF-1.4\n% simulated work\n')
+    with open(path,'w',newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['identifier1','title1','creator1','resource_type1','license1','files','fulltext_url'])
+        for n in range(works):
+            identifier = replay.identifiers[n] if n < len(replay.identifiers) else 'sim{:07d}'.format(n)
+            fulltext_url = '{}/files/{}/{}.pdf'.format(url.rstrip('/'),replay.outcome(identifier,1).downloaded_bytes,n) if url else ''
+            writer.writerow([identifier,'Simulated work {}'.format(n),'Simulator','Other',
+                             'http://creativecommons.org/licenses/by/3.0/us/',os.path.basename(sample),fulltext_url])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='make journals and manifests to replay with batch_loader.py --backend simulated')
+    commands = parser.add_subparsers(dest='command')
+    make_journal = commands.add_parser('journal',help='make up a journal, when there is no --work-stats csv of a real run')
+    make_journal.add_argument('journal')
+    make_journal.add_argument('--works',type=int,default=1000)
+    make_journal.add_argument('--fail-rate',type=float,help='share of attempts that fail [default: 0.5, like fake_rake.py]',default=0.5)
+    make_journal.add_argument('--import-seconds',type=float,help='median seconds an import takes [default: 2]',default=2.0)
+    make_journal.add_argument('--download-bytes',type=int,help='median bytes downloaded for a work [default: 1MB]',default=1024 * 1024)
+    make_journal.add_argument('--seed',type=int,default=0)
+    make_manifest = commands.add_parser('manifest',help='write a csv of works to replay a journal with')
+    make_manifest.add_argument('journal')
+    make_manifest.add_argument('manifest')
+    make_manifest.add_argument('--works',type=int,help='how many works [default: the works in the journal]',default=None)
+    make_manifest.add_argument('--url',type=str,help='base url of an ingest_receiver.py to download the files from, for runs with --url',default=None)
+    make_manifest.add_argument('--seed',type=int,help='the --sim-seed the manifest will be replayed with',default=0)
+    args = parser.parse_args()
+    if args.command == 'journal':
+        write_journal(args.journal,args.works,args.fail_rate,args.import_seconds,args.download_bytes,args.seed)
+    elif args.command == 'manifest':
+        write_manifest(args.manifest,Replay(load_journal(args.journal),seed=args.seed),args.works,args.url)
+    else:
+        parser.print_help()
+        sys.exit(1)
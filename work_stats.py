@@ -0,0 +1,214 @@
+import os
+import csv
+import time
+import heapq
+import bisect
+import signal
+import threading
+import subprocess
+from contextlib import contextmanager
+from FormatLog import FormatLogger
+try:
+    import resource # cpu time of child processes, not on windows
+except ImportError:
+    resource = None
+
+logger = FormatLogger()
+stages = ('download','tiff','import') # stages timed by batch_loader's metrics, recorded per work
+stats_fields = ('identifier','attempt','result','error','retry_class','wall_seconds','child_cpu_seconds','disk_bytes','downloaded_bytes','slow') + \
+    tuple(stage + '_seconds' for stage in stages)
+
+class WorkTimeout(Exception):
+    """ a work ran past --work-timeout, whatever it was running has been killed """
+    timed_out = True # the rate controller counts it as congestion
+
+class WorkMonitor():
+    """ measures every work as it is ingested: wall time, cpu time of the commands it ran (rake, convert),
+        bytes its files took on disk and bytes downloaded for it. warns about works slower than
+        the given percentile of the works before them, and gives each work a deadline if there is a timeout
+    """
+    def __init__(self,percentile = 95,timeout = None,stats_file = None,min_works = 20,slowest = 10):
+        self.percentile = percentile # a work slower than this percentile of the works so far is flagged
+        self.timeout = timeout # seconds a work may take, None for no limit
+        self.min_works = min_works # works to see before flagging any, the percentile means little before that
+        self.bytes_downloaded = lambda: 0 # set to a function returning the bytes downloaded so far
+        self.stage_seconds = lambda: {} # set to a function returning stage -> seconds spent in it so far
+        self.wall_times = [] # sorted wall times of finished attempts
+        self.slowest = [] # heap of (wall time, identifier) of the slowest attempts
+        self.num_slowest = slowest
+        self.num_slow = 0
+        self.deadline = None
+        self.paused_seconds = 0.0 # seconds of the current work spent waiting on the rate controller
+        self.started = None # (wall clock, child cpu, bytes downloaded, stage seconds) when the current work started
+        self.stats_file = open(stats_file,'w',newline='') if stats_file else None
+        self.writer = None
+        if self.stats_file:
+            self.writer = csv.writer(self.stats_file)
+            self.writer.writerow(stats_fields)
+
+    def begin(self):
+        """ call as a work starts """
+        now = time.monotonic()
+        self.deadline = now + self.timeout if self.timeout else None
+        self.paused_seconds = 0.0
+        self.started = (now,child_cpu_time(),self.bytes_downloaded(),self.stage_seconds())
+
+    @contextmanager
+    def paused(self):
+        """ with work_monitor.paused(): ... the block is not counted against the current work,
+            its deadline moves back by as long as the block took and its wall time leaves it out.
+            for pacing by the rate controller, which says nothing about the work itself """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            paused = time.monotonic() - start
+            self.paused_seconds += paused
+            if self.deadline is not None:
+                self.deadline += paused
+
+    def remaining(self):
+        """ Returns: seconds left before the current work times out, None if there is no timeout
+            Raises: WorkTimeout if there are none left """
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise WorkTimeout('work took longer than {} seconds'.format(self.timeout))
+        return remaining
+
+    def threshold(self):
+        """ Returns: the wall time at self.percentile of the works so far, None until there are min_works """
+        if len(self.wall_times) < self.min_works:
+            return None
+        return self.wall_times[min(len(self.wall_times) - 1,int(len(self.wall_times) * self.percentile / 100))]
+
+    def end(self,identifier,attempt,error = None,download_dir = None,retry_class = None):
+        """
+        Desc: call as a work finishes, before its files are cleaned up so their size can be measured
+        Args: identifier (str): what the work is called in the logs
+              attempt (int): which attempt this was
+              error (Exception): what stopped it, None if it was ingested
+              download_dir (str): where its files were downloaded to, if anywhere
+              retry_class (str): what kind of failure error was, see retry_policy.py
+        """
+        start, cpu, downloaded, stage_seconds = self.started
+        wall = time.monotonic() - start - self.paused_seconds
+        cpu = child_cpu_time() - cpu
+        downloaded = self.bytes_downloaded() - downloaded
+        disk = directory_size(download_dir) if download_dir else 0
+        threshold = self.threshold()
+        slow = threshold is not None and wall > threshold
+        if slow:
+            self.num_slow += 1
+            logger.warning('slow work {}: took {:.2f}s, {:.0f}th percentile is {:.2f}s (child cpu {:.1f}s, {:.1f}MB on disk, {:.1f}MB downloaded)'.format(
+                identifier,wall,self.percentile,threshold,cpu,disk / 1024 / 1024,downloaded / 1024 / 1024))
+        bisect.insort(self.wall_times,wall)
+        heapq.heappush(self.slowest,(wall,str(identifier)))
+        if len(self.slowest) > self.num_slowest:
+            heapq.heappop(self.slowest)
+        if self.writer:
+            if isinstance(identifier,list): # json works can have more than one
+                identifier = identifier[0] if identifier else None
+            now = self.stage_seconds()
+            self.writer.writerow((identifier,attempt,'failure' if error else 'success',error.__class__.__name__ if error else '',retry_class or '',
+                                  '{:.3f}'.format(wall),'{:.3f}'.format(cpu),disk,downloaded,int(slow)) + \
+                                 tuple('{:.3f}'.format(now.get(stage,0) - stage_seconds.get(stage,0)) for stage in stages))
+            self.stats_file.flush()
+        self.deadline = None
+
+    def summary(self):
+        """ Returns: lines describing the slowest works """
+        lines = ['{} works were slower than the {:.0f}th percentile, the slowest were:'.format(self.num_slow,self.percentile)]
+        lines += ['    {:.2f}s {}'.format(wall,identifier) for wall, identifier in sorted(self.slowest,reverse=True)]
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.stats_file:
+            self.stats_file.close()
+
+def child_cpu_time():
+    """ Returns: user and system cpu seconds used by child processes that have finished """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def directory_size(path):
+    """ Returns: bytes used by the files under path """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root,name)).st_size
+            except OSError:
+                pass
+    return size
+
+def run_command(command,timeout = None,check = True,cwd = None,stderr = None,stdin_chunks = None):
+    """
+    Desc: runs a command like subprocess.check_output, but with a timeout the command runs in its own
+        process group and everything it started is killed if it runs too long (rake and convert start children,
+        killing just the first process would leave them running). they get SIGTERM first so sudo can pass it on
+    Args: command (list): the command and its arguments
+          timeout (float): seconds to let it run, None for no limit
+          check (Boolean): raise CalledProcessError if it exits non zero
+          stdin_chunks (iterable): Optional - bytes to write to its stdin as they are made, ie ingest_backend.TarStream
+    Returns: what it wrote to stdout (bytes)
+    Raises: WorkTimeout if it was killed
+    """
+    if timeout is None and stdin_chunks is None:
+        output = subprocess.run(command,cwd=cwd,stdout=subprocess.PIPE,stderr=stderr)
+        if check:
+            output.check_returncode()
+        return output.stdout
+    process = subprocess.Popen(command,cwd=cwd,stdin=subprocess.PIPE if stdin_chunks is not None else None,
+                               stdout=subprocess.PIPE,stderr=stderr,start_new_session=True)
+    feeder, errors = None, []
+    if stdin_chunks is not None:
+        # written from another thread while stdout is read here, communicate() would buffer it all first
+        feeder = threading.Thread(target=feed,args=(process.stdin,stdin_chunks,errors),daemon=True)
+        process.stdin = None # so communicate leaves it to the feeder
+        feeder.start()
+    try:
+        output, _ = process.communicate(timeout=timeout)
+        if feeder:
+            feeder.join()
+            if errors: # ie a file could not be read, what it was given is incomplete
+                raise errors[0]
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        raise WorkTimeout('{} was still running after {:.0f} seconds and was killed'.format(command[0],timeout))
+    except BaseException: # ctrl-c no longer reaches a process in its own group
+        kill_process_group(process)
+        raise
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode,command,output)
+    return output
+
+def feed(pipe,chunks,errors):
+    """ writes chunks to pipe and closes it, an error making the chunks is added to errors """
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except (BrokenPipeError,ValueError): # it exited or was killed without reading everything
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+def kill_process_group(process,grace = 5):
+    for sig in (signal.SIGTERM,signal.SIGKILL):
+        try:
+            os.killpg(process.pid,sig)
+        except (ProcessLookupError,PermissionError):
+            pass
+        try:
+            process.communicate(timeout=grace)
+            return
+        except subprocess.TimeoutExpired:
+            pass